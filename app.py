@@ -4,18 +4,34 @@ import tempfile
 import io
 import zipfile
 import hashlib
+import time
 import pandas as pd
 from pypdf import PdfReader
 from core_logic import (
-    convert_pdf_to_images,
+    iter_cached_page_files,
+    estimate_vision_payload,
+    get_render_cache_stats,
     call_vision_api,
-    parse_gemini_response,
-    parse_openai_response,
-    parse_anthropic_response,
-    parse_qwen_response,
-    parse_zhipu_response,
+    parse_vision_response,
+    recognize_toc_by_page,
+    recognize_toc_with_failover,
+    HEDGE_AFTER_SECONDS,
+    get_provider_adapter,
     split_pdf,
     split_pdf_with_ranges,
+    extract_outline_toc,
+    extract_text_layer,
+    is_usable_text_layer,
+    build_text_toc_prompt,
+    prompt_text,
+    get_vision_usage,
+    detect_page_offset,
+    ENCODING_PROFILES,
+    with_preprocessing,
+    encode_image_cached,
+    get_encode_cache_stats,
+    get_vision_cache_stats,
+    summarize_vision_calls,
     create_zip
 )
 
@@ -28,6 +44,38 @@ if 'pdf_path' not in st.session_state:
     st.session_state.pdf_path = None
 if 'current_filename' not in st.session_state:
     st.session_state.current_filename = None
+if 'pdf_sha256' not in st.session_state:
+    st.session_state.pdf_sha256 = None
+if 'pdf_page_count' not in st.session_state:
+    st.session_state.pdf_page_count = None
+if 'preview_group' not in st.session_state:
+    st.session_state.preview_group = 1
+if 'zoom_page' not in st.session_state:
+    st.session_state.zoom_page = None
+if 'offset_detection' not in st.session_state:
+    st.session_state.offset_detection = None
+if 'offset_detected_for' not in st.session_state:
+    st.session_state.offset_detected_for = None
+if 'use_text_layer' not in st.session_state:
+    st.session_state.use_text_layer = True
+if 'per_page_recognition' not in st.session_state:
+    st.session_state.per_page_recognition = False
+if 'pages_per_request' not in st.session_state:
+    st.session_state.pages_per_request = 1
+if 'stream_recognition' not in st.session_state:
+    st.session_state.stream_recognition = True
+if 'fallback_providers' not in st.session_state:
+    st.session_state.fallback_providers = []
+if 'fallback_chain' not in st.session_state:
+    st.session_state.fallback_chain = []
+if 'hedge_after' not in st.session_state:
+    st.session_state.hedge_after = int(HEDGE_AFTER_SECONDS)
+if 'use_vision_cache' not in st.session_state:
+    st.session_state.use_vision_cache = True
+if 'recognition_report' not in st.session_state:
+    st.session_state.recognition_report = None
+if 'vision_baseline' not in st.session_state:
+    st.session_state.vision_baseline = None
 if 'toc_data' not in st.session_state:
     st.session_state.toc_data = []
 if 'preview_images' not in st.session_state:
@@ -68,6 +116,12 @@ if 'base_url' not in st.session_state:
     st.session_state.base_url = ''
 if 'model_name' not in st.session_state:
     st.session_state.model_name = 'gpt-4o'
+if 'image_budget' not in st.session_state:
+    st.session_state.image_budget = None
+if 'encoding_profile' not in st.session_state:
+    st.session_state.encoding_profile = 'original'  # 默认不重新编码，可在步骤3按次调整
+if 'preprocess_scans' not in st.session_state:
+    st.session_state.preprocess_scans = False
 
 # ==================== 从localStorage加载API设置 ====================
 
@@ -128,6 +182,28 @@ STEPS = {
 }
 
 # ==================== 辅助函数 ====================
+THUMBNAILS_PER_GROUP = 10
+THUMBNAIL_MAX_SIDE = 360  # 缩略图最长边像素
+
+OFFSET_AUTO_APPLY_CONFIDENCE = 0.6
+
+def apply_detected_offset(offset):
+    """把检测到的偏移量写回两个参考页码输入框"""
+    if offset >= 0:
+        st.session_state.offset_ref_book_page = 1
+        st.session_state.offset_ref_pdf_page = 1 + offset
+    else:
+        st.session_state.offset_ref_book_page = 1 - offset
+        st.session_state.offset_ref_pdf_page = 1
+
+def get_pdf_page_count():
+    if st.session_state.get('pdf_page_count') is None and st.session_state.get('pdf_path'):
+        try:
+            st.session_state.pdf_page_count = len(PdfReader(st.session_state.pdf_path, strict=False).pages)
+        except Exception as e:
+            print(f"Error reading page count: {e}")
+    return st.session_state.get('pdf_page_count')
+
 def is_step_enabled(step_num):
     if step_num == 1: return True
     if step_num == 2: return st.session_state.get('pdf_path') is not None
@@ -219,6 +295,12 @@ def render_step_1():
             with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
                 tmp_file.write(uploaded_file.getvalue())
                 st.session_state.pdf_path = tmp_file.name
+            # 内容哈希：页面渲染缓存的键，同一本书重复上传可直接复用
+            st.session_state.pdf_sha256 = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+            st.session_state.pdf_page_count = None
+            st.session_state.preview_group = 1
+            st.session_state.zoom_page = None
+            st.session_state.recognition_report = None
             st.session_state.current_filename = uploaded_file.name
             st.session_state.toc_data = []
             st.session_state.preview_images = []
@@ -242,7 +324,7 @@ def render_step_2():
     col1, col2 = st.columns([1, 2])
 
     with col1:
-        st.info("请查看右侧预览图，确定目录所在的页码范围。")
+        st.info("请查看右侧预览图（可翻页浏览全书），确定目录所在的页码范围。")
         # IMPORTANT: Do NOT use 'key' for conditionally rendered widgets!
         # Streamlit clears key-bound values when the widget is not rendered.
         # Use manual session state assignment instead.
@@ -265,6 +347,22 @@ def render_step_2():
         st.markdown("---")
         st.subheader("📏 页码偏移设置")
         st.caption("用于将书本页码转换为PDF页码")
+
+        # 偏移量自动检测放在缩略图渲染之后进行（见下方），不拖慢首次预览
+        offset_pending = st.session_state.offset_detected_for != st.session_state.pdf_sha256
+        detection = st.session_state.offset_detection
+        if offset_pending:
+            st.caption("⏳ 缩略图显示后将自动检测页码偏移...")
+        elif detection:
+            source_label = "PDF 页码标签 (/PageLabels)" if detection['source'] == "page_labels" else f"正文页印刷页码（{detection['samples']} 页采样）"
+            st.caption(f"🎯 自动检测: 偏移量 {detection['offset']}，来源: {source_label}，置信度 {detection['confidence']:.0%}")
+            if detection['confidence'] < OFFSET_AUTO_APPLY_CONFIDENCE:
+                st.warning("自动检测置信度较低，未自动填入，请对照预览图确认。")
+                if st.button("使用检测结果"):
+                    apply_detected_offset(detection['offset'])
+                    st.rerun()
+        else:
+            st.caption("未能自动检测偏移量（PDF 无页码标签或文本层），请手动填写。")
         
         offset_ref_book_page = st.number_input(
             "参考：正文第1课在书上的页码", 
@@ -289,37 +387,96 @@ def render_step_2():
         st.success(f"✓ 页码偏移量: **{calculated_offset}**")
         st.caption(f"公式: PDF页码 = 书本页码 + {calculated_offset}")
 
-        if st.button("生成预览图"):
-            # State is already updated via keys
+    with col2:
+        render_thumbnail_browser()
+
+    # 首次进入时自动检测偏移量（/PageLabels 或正文页印刷页码），每个 PDF 只检测一次
+    if offset_pending:
+        with col1:
+            with st.spinner("正在自动检测页码偏移..."):
+                detection = detect_page_offset(st.session_state.pdf_path)
+        st.session_state.offset_detection = detection
+        st.session_state.offset_detected_for = st.session_state.pdf_sha256
+        if detection and detection['confidence'] >= OFFSET_AUTO_APPLY_CONFIDENCE:
+            apply_detected_offset(detection['offset'])
+        # 重新运行以把检测结果填入上方输入框（缩略图命中缓存，重绘很快）
+        st.rerun()
+
+def render_thumbnail_browser():
+    """
+    全书缩略图浏览：按组分页，只渲染当前组的低分辨率缩略图，
+    点击「放大」时才渲染该页的全尺寸图（与步骤3共用渲染缓存）。
+    """
+    total_pages = get_pdf_page_count()
+    if not total_pages:
+        st.warning("无法读取 PDF 页数")
+        return
+
+    group_count = (total_pages + THUMBNAILS_PER_GROUP - 1) // THUMBNAILS_PER_GROUP
+    st.session_state.preview_group = min(max(1, st.session_state.preview_group), group_count)
 
-            with st.spinner("正在生成预览..."):
-                images = convert_pdf_to_images(st.session_state.pdf_path, 1, 10)
-                st.session_state.preview_images = images
+    nav_cols = st.columns([1, 2, 1, 2])
+    with nav_cols[0]:
+        if st.button("◀ 上一组", disabled=st.session_state.preview_group <= 1):
+            st.session_state.preview_group -= 1
+            st.rerun()
+    with nav_cols[1]:
+        preview_group = st.number_input(
+            f"页组（共 {group_count} 组）",
+            min_value=1,
+            max_value=group_count,
+            value=st.session_state.preview_group
+        )
+        st.session_state.preview_group = preview_group
+    with nav_cols[2]:
+        if st.button("下一组 ▶", disabled=st.session_state.preview_group >= group_count):
+            st.session_state.preview_group += 1
+            st.rerun()
+    with nav_cols[3]:
+        if st.button("跳到目录起始页"):
+            st.session_state.preview_group = (st.session_state.toc_start - 1) // THUMBNAILS_PER_GROUP + 1
             st.rerun()
 
-    with col2:
-        if st.session_state.preview_images:
-            st.write("**PDF 前 10 页预览:**")
-            # First row: pages 1-5
-            row1_cols = st.columns(5)
-            for i in range(min(5, len(st.session_state.preview_images))):
-                with row1_cols[i]:
-                    img = st.session_state.preview_images[i]
-                    st.image(img, caption=f"Page {i+1}")
-                    with st.expander(f"🔍 放大"):
-                        st.image(img)
-
-            # Second row: pages 6-10
-            if len(st.session_state.preview_images) > 5:
-                row2_cols = st.columns(5)
-                for i in range(5, min(10, len(st.session_state.preview_images))):
-                    with row2_cols[i-5]:
-                        img = st.session_state.preview_images[i]
-                        st.image(img, caption=f"Page {i+1}")
-                        with st.expander(f"🔍 放大"):
-                            st.image(img)
-        else:
-            st.info("点击左侧「生成预览图」按钮查看 PDF 页面")
+    first_page = (st.session_state.preview_group - 1) * THUMBNAILS_PER_GROUP + 1
+    last_page = min(first_page + THUMBNAILS_PER_GROUP - 1, total_pages)
+    st.write(f"**PDF 第 {first_page} - {last_page} 页预览（共 {total_pages} 页）:**")
+
+    with st.spinner("正在生成预览..."):
+        thumbnails = list(iter_cached_page_files(
+            st.session_state.pdf_path, first_page, last_page,
+            image_budget=THUMBNAIL_MAX_SIDE,
+            pdf_hash=st.session_state.pdf_sha256
+        ))
+    st.session_state.preview_images = thumbnails
+
+    for row_start in range(0, len(thumbnails), 5):
+        row_cols = st.columns(5)
+        for i, img in enumerate(thumbnails[row_start:row_start + 5]):
+            page = first_page + row_start + i
+            with row_cols[i]:
+                st.image(img, caption=f"Page {page}")
+                if st.button("🔍 放大", key=f"zoom_{page}"):
+                    st.session_state.zoom_page = page
+                    st.rerun()
+
+    zoom_page = st.session_state.get('zoom_page')
+    if zoom_page and zoom_page <= total_pages:
+        st.markdown("---")
+        zoom_cols = st.columns([4, 1])
+        with zoom_cols[0]:
+            st.write(f"**Page {zoom_page}（原图）**")
+        with zoom_cols[1]:
+            if st.button("✕ 关闭"):
+                st.session_state.zoom_page = None
+                st.rerun()
+        with st.spinner("正在渲染原图..."):
+            full_images = list(iter_cached_page_files(
+                st.session_state.pdf_path, zoom_page, zoom_page,
+                image_budget=st.session_state.get('image_budget'),
+                pdf_hash=st.session_state.pdf_sha256
+            ))
+        if full_images:
+            st.image(full_images[0])
 
 # ==================== 步骤3：AI识别 ====================
 def render_step_3():
@@ -342,52 +499,232 @@ def render_step_3():
     
     st.markdown("---")
 
+    # 书签快速通道：数字版 PDF 自带目录书签时，无需渲染页面或调用 AI
+    if st.button("📑 从 PDF 书签读取目录（无需 API）"):
+        outline_toc = extract_outline_toc(st.session_state.pdf_path, offset=st.session_state.calculated_offset)
+        if outline_toc:
+            st.session_state.toc_data = outline_toc
+            st.toast(f"📑 从书签读取 {len(outline_toc)} 个章节!", icon="✅")
+            st.rerun()
+        else:
+            st.warning("该 PDF 没有可用的书签目录，请使用 AI 识别。")
+    st.caption("页码已按当前偏移量换算为书本页码；修改偏移量后请重新读取。")
+
     api_key = st.session_state.get('api_key', '')
     if not api_key:
         st.error("请先在侧边栏配置 API Key")
     else:
+        use_text_layer = st.checkbox(
+            "优先使用目录页文本层（无需图片，更快更省流量）",
+            value=st.session_state.use_text_layer,
+            help="数字版 PDF 的目录页通常带有可提取的文字；提取失败或乱码时会自动改用图片识别"
+        )
+        st.session_state.use_text_layer = use_text_layer
+
+        profile_names = list(ENCODING_PROFILES.keys())
+        current_profile = st.session_state.encoding_profile
+        encoding_profile = st.selectbox(
+            "图片编码方式",
+            options=profile_names,
+            index=profile_names.index(current_profile) if current_profile in profile_names else 0,
+            format_func=lambda name: ENCODING_PROFILES[name]["label"] if ENCODING_PROFILES[name] else "原图 JPEG（不重新编码）",
+            help="黑白扫描的目录页用灰度或二值编码，体积可减小数倍且识别效果相当；编码前后大小会打印在服务端日志中"
+        )
+        st.session_state.encoding_profile = encoding_profile
+
+        preprocess_scans = st.checkbox(
+            "扫描页预处理（裁白边 / 纠偏 / 二值化）",
+            value=st.session_state.preprocess_scans,
+            help="适合带大片白边和灰底噪点的扫描目录页，可显著减小上传体积；数字版 PDF 通常不需要"
+        )
+        st.session_state.preprocess_scans = preprocess_scans
+        if preprocess_scans:
+            encoding_profile = with_preprocessing(encoding_profile)
+
+        per_page_recognition = st.checkbox(
+            "多页目录分组并发识别",
+            value=st.session_state.per_page_recognition,
+            help="每组目录页单独发一个请求并同时进行，结果按页序合并；目录页较多时明显更快，也不易触及输出长度上限"
+        )
+        st.session_state.per_page_recognition = per_page_recognition
+        if per_page_recognition:
+            pages_per_request = st.number_input(
+                "每个请求包含的页数",
+                min_value=1,
+                max_value=10,
+                value=st.session_state.pages_per_request,
+                step=1
+            )
+            st.session_state.pages_per_request = pages_per_request
+
+        stream_recognition = st.checkbox(
+            "流式显示识别进度",
+            value=st.session_state.stream_recognition,
+            help="边生成边显示已识别的章节，长目录不必等到全部完成；个别不支持流式输出的接口请取消勾选（分组并发识别或启用备用服务商时不使用）"
+        )
+        st.session_state.stream_recognition = stream_recognition
+
+        use_vision_cache = st.checkbox(
+            "复用识别缓存",
+            value=st.session_state.use_vision_cache,
+            help="同一本书、相同提示词和模型的识别结果会缓存在服务器上，再次识别无需调用 API；取消勾选可强制重新识别"
+        )
+        st.session_state.use_vision_cache = use_vision_cache
+
         if st.button("🚀 开始 AI 识别", type="primary"):
                 progress_container = st.empty()
                 progress_container.info("🔄 正在将目录页面发送至 AI...")
                 
                 with st.spinner("正在分析目录..."):
-                    toc_images = convert_pdf_to_images(st.session_state.pdf_path, st.session_state.toc_start, st.session_state.toc_end)
+                    run_start = time.perf_counter()
+                    prompt = st.session_state.ai_prompt
+                    image_budget = st.session_state.get('image_budget')
+                    toc_page_count = st.session_state.toc_end - st.session_state.toc_start + 1
+
+                    page_texts = []
+                    prompt_usage = None
+                    partial_result = False
+                    if use_text_layer:
+                        page_texts = extract_text_layer(st.session_state.pdf_path, st.session_state.toc_start, st.session_state.toc_end)
+
+                    if is_usable_text_layer(page_texts):
+                        # 文本通道：只发送提取出的目录文字，不渲染、不上传图片
+                        recognition_path = "text"
+                        prompt = build_text_toc_prompt(prompt, page_texts)
+                        toc_images = []
+                        payload_bytes = len(prompt_text(prompt).encode('utf-8'))
+                        # 图片通道的请求体估算：按服务商尺寸上限的渲染缓存计算，不调用 API
+                        est_image_bytes = estimate_vision_payload(
+                            st.session_state.pdf_sha256,
+                            st.session_state.toc_start,
+                            st.session_state.toc_end,
+                            image_budget=image_budget
+                        )
+                        est_vision_bytes = None if est_image_bytes is None else len(prompt_text(st.session_state.ai_prompt).encode('utf-8')) + est_image_bytes
+                    else:
+                        # 图片通道：逐页渲染（或命中缓存），只向下游传递文件路径
+                        # 直接按服务商的图片尺寸上限渲染，避免多余像素
+                        # 以生成器传给 API 调用：每渲染完一页就提交到编码线程池，渲染与编码重叠进行
+                        recognition_path = "vision"
+                        rendered_pages = []
+
+                        def render_toc_pages():
+                            for page_file in iter_cached_page_files(
+                                st.session_state.pdf_path,
+                                st.session_state.toc_start,
+                                st.session_state.toc_end,
+                                image_budget=image_budget,
+                                pdf_hash=st.session_state.pdf_sha256
+                            ):
+                                rendered_pages.append(page_file)
+                                yield page_file
+
+                        toc_images = render_toc_pages()
+                        payload_bytes = None
+                        est_vision_bytes = None
                     
                     progress_container.info("🧠 AI 正在分析目录结构...")
 
-                    prompt = st.session_state.ai_prompt
-
                     selected_provider = st.session_state.get('selected_provider', 'OpenAI')
                     base_url = st.session_state.get('base_url', 'https://api.openai.com/v1')
                     model_name = st.session_state.get('model_name', 'gpt-4o')
 
-                    response = call_vision_api(selected_provider, api_key, base_url, model_name, toc_images, prompt)
-
-                    if "error" in response:
-                        st.error(f"API Error: {response['error']}")
+                    if recognition_path == "vision" and per_page_recognition:
+                        # 分组并发：每组一个请求，结果按页序合并；部分分组失败时保留其余结果
+                        result = recognize_toc_by_page(
+                            selected_provider, api_key, base_url, model_name, toc_images, prompt,
+                            pages_per_request=st.session_state.pages_per_request,
+                            image_budget=image_budget,
+                            encoding_profile=encoding_profile,
+                            use_cache=use_vision_cache
+                        )
+                        from_cache = result["groups"] > 0 and result["cached_groups"] == result["groups"]
+                        parsed_data = result["chapters"]
+                        api_error = "; ".join(result["errors"]) if result["errors"] and not parsed_data else None
+                        if result["errors"] and parsed_data:
+                            st.warning(f"{len(result['errors'])} 组目录页识别失败，结果可能不完整: {'; '.join(result['errors'])}")
+                    elif st.session_state.fallback_chain:
+                        # 故障转移：主服务商失败或超过对冲阈值时依次请求备用服务商，先返回可解析结果者胜出
+                        # （请求在后台线程中进行，因此不使用流式显示）
+                        chain = [{"provider": selected_provider, "api_key": api_key, "base_url": base_url, "model": model_name}]
+                        chain += st.session_state.fallback_chain
+                        result = recognize_toc_with_failover(
+                            chain, toc_images, prompt,
+                            hedge_after=st.session_state.hedge_after,
+                            encoding_profile=encoding_profile,
+                            use_cache=use_vision_cache
+                        )
+                        parsed_data = result["chapters"]
+                        api_error = None if parsed_data else result["error"]
+                        from_cache = bool(result["response"]) and "from_cache" in result["response"]
+                        if result["provider"] and result["provider"] != selected_provider:
+                            st.toast(f"🛟 结果来自备用服务商 {result['provider']}", icon="🛟")
                     else:
-                        if selected_provider == "Google Gemini":
-                            parsed_data = parse_gemini_response(response)
-                        elif selected_provider == "OpenAI":
-                            parsed_data = parse_openai_response(response)
-                        elif selected_provider == "Anthropic Claude":
-                            parsed_data = parse_anthropic_response(response)
-                        elif selected_provider == "智谱 AI (Zhipu AI)":
-                            parsed_data = parse_zhipu_response(response)
-                        elif selected_provider == "阿里通义千问 (Qwen)":
-                            parsed_data = parse_qwen_response(response)
-                        else:
-                            parsed_data = parse_openai_response(response)
+                        # 流式：每解析出一个完整章节就刷新表格
+                        live_chapters = []
+                        live_table = st.empty()
 
+                        def show_chapter(chapter):
+                            live_chapters.append(chapter)
+                            progress_container.info(f"🧠 已识别 {len(live_chapters)} 个章节...")
+                            live_table.dataframe(pd.DataFrame(live_chapters), hide_index=True)
+
+                        response = call_vision_api(
+                            selected_provider, api_key, base_url, model_name, toc_images, prompt,
+                            image_budget=image_budget,
+                            encoding_profile=encoding_profile,
+                            use_cache=use_vision_cache,
+                            on_chapter=show_chapter if stream_recognition else None
+                        )
+                        from_cache = "from_cache" in response
+                        api_error = response.get("error")
+                        if not api_error and not from_cache:
+                            prompt_usage = get_vision_usage(selected_provider, response)
+                        parsed_data = [] if api_error else parse_vision_response(selected_provider, response)
+                        if not parsed_data and live_chapters:
+                            # 兜底：解析失败或请求中途出错时保留流式阶段已完整收到的章节
+                            parsed_data = live_chapters
+                            if api_error:
+                                st.toast(f"⚠️ 识别中途出错（{api_error}），已保留收到的 {len(live_chapters)} 个章节，结果可能不完整", icon="⚠️")
+                                api_error = None
+                                partial_result = True
+
+                    elapsed = time.perf_counter() - run_start
+                    if payload_bytes is None:
+                        # 编码结果已在编码缓存中，这里只是取回长度
+                        payload_bytes = len(prompt_text(prompt).encode('utf-8')) + sum(len(encode_image_cached(p, encoding_profile)) for p in rendered_pages)
+                    st.session_state.recognition_report = {
+                        "path": recognition_path,
+                        "seconds": elapsed,
+                        "payload_bytes": payload_bytes,
+                        "pages": toc_page_count,
+                        "from_cache": from_cache,
+                        "usage": prompt_usage,
+                        "est_vision_bytes": est_vision_bytes,
+                    }
+                    if recognition_path == "vision" and not api_error and not partial_result and not from_cache and toc_page_count > 0:
+                        # 记录图片通道的每页开销，用于估算文本通道节省了多少
+                        st.session_state.vision_baseline = {
+                            "seconds_per_page": elapsed / toc_page_count,
+                            "bytes_per_page": payload_bytes / toc_page_count,
+                        }
+
+                    if api_error:
+                        st.error(f"API Error: {api_error}")
+                    else:
                         if parsed_data:
                             st.session_state.toc_data = parsed_data
                             progress_container.success("✅ 分析完成!")
                             st.success(f"成功识别 {len(parsed_data)} 个章节！")
                             st.toast(f"🤖 成功识别 {len(parsed_data)} 个章节!", icon="✅")
+                            if from_cache:
+                                st.toast("⚡ 识别结果来自缓存，未调用 API", icon="⚡")
                             st.rerun()
                         else:
                             st.error("未能解析出有效的 JSON 数据。")
 
+    render_recognition_report()
+
     # 默认提示词（存储在 session state 中，允许用户编辑）
     if 'ai_prompt' not in st.session_state:
         default_prompt = """# Role
@@ -544,6 +881,44 @@ def render_step_3():
         st.session_state.final_toc = final_toc
 
 
+def render_recognition_report():
+    """显示最近一次识别走的通道、耗时和请求体大小"""
+    report = st.session_state.get('recognition_report')
+    if not report:
+        return
+    path_label = "📝 文本层通道（未上传图片）" if report['path'] == "text" else "🖼️ 图片识别通道"
+    if report.get('from_cache'):
+        st.caption(f"上次识别: {path_label} · ⚡ 结果来自缓存（未调用 API）· 耗时 {report['seconds']:.2f} 秒")
+        return
+    st.caption(f"上次识别: {path_label} · 耗时 {report['seconds']:.1f} 秒 · 请求体约 {report['payload_bytes'] / 1024:.1f} KB")
+    usage = report.get('usage')
+    if usage and usage.get('input_tokens') and usage.get('cached_input_tokens') is not None:
+        # 固定的提示词前缀由服务商缓存，命中部分按缓存价计费
+        st.caption(f"提示词缓存命中 {usage['cached_input_tokens']} / {usage['input_tokens']} 输入 tokens")
+
+    if report['path'] != "text":
+        return
+    baseline = st.session_state.get('vision_baseline')
+    if baseline:
+        est_seconds = baseline['seconds_per_page'] * report['pages']
+        est_bytes = baseline['bytes_per_page'] * report['pages']
+        st.caption(
+            f"相比图片通道（按本次会话实测估算）: 节省约 {max(0.0, est_seconds - report['seconds']):.1f} 秒、"
+            f"{max(0.0, est_bytes - report['payload_bytes']) / 1024:.1f} KB"
+        )
+    elif report.get('est_vision_bytes') is not None:
+        # 没有实测耗时，只能按渲染缓存估算请求体大小
+        st.caption(
+            f"相比图片通道（按渲染缓存估算请求体约 {report['est_vision_bytes'] / 1024:.1f} KB）: "
+            f"少上传约 {max(0, report['est_vision_bytes'] - report['payload_bytes']) / 1024:.1f} KB；"
+            f"本次会话尚无图片通道实测，无法估算节省的耗时"
+        )
+    else:
+        st.caption(
+            f"文本通道请求体约 {report['payload_bytes'] / 1024:.1f} KB；"
+            f"无图片通道基线（本次会话未走过图片通道，目录页也未按当前服务商尺寸渲染过），暂无法估算节省量"
+        )
+
 # ==================== 步骤4：切分下载 ====================
 def render_step_4():
     st.subheader("✂️ 切分下载")
@@ -990,6 +1365,41 @@ with st.sidebar:
     # 当前步骤
     current = st.session_state.get('current_step', 1)
     st.markdown(f"**🚀 当前步骤**: {current}. {STEPS.get(current, '')}")
+
+    # 渲染缓存
+    cache_stats = get_render_cache_stats()
+    if cache_stats['hits'] or cache_stats['misses']:
+        st.caption(f"🗂️ 页面渲染缓存: 命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']}（命中率 {cache_stats['hit_rate']:.0%}）")
+    encode_stats = get_encode_cache_stats()
+    if encode_stats['hits'] or encode_stats['misses']:
+        st.caption(f"🧮 图片编码缓存: 命中率 {encode_stats['hit_rate']:.0%}，节省 CPU {encode_stats['saved_seconds']:.2f} 秒")
+    vision_stats = get_vision_cache_stats()
+    if vision_stats['hits'] or vision_stats['misses']:
+        st.caption(f"⚡ 识别结果缓存: 命中 {vision_stats['hits']} / 未命中 {vision_stats['misses']}（命中率 {vision_stats['hit_rate']:.0%}）")
+
+    # 调用统计：按服务商/模型汇总最近 7 天的耗时分位数与 token 用量
+    with st.expander("📊 识别调用统计（最近 7 天）", expanded=False):
+        usage_summary = summarize_vision_calls(since=time.time() - 7 * 86400)
+        if usage_summary:
+            st.dataframe(pd.DataFrame([{
+                "服务商": row["provider"],
+                "模型": row["model"],
+                "调用": row["calls"],
+                "缓存": row["cached"],
+                "失败": row["errors"],
+                "解析成功率": f"{row['parse_rate']:.0%}" if row["parse_rate"] is not None else "-",
+                "P50 耗时(秒)": row["p50_seconds"],
+                "P90 耗时(秒)": row["p90_seconds"],
+                "P99 耗时(秒)": row["p99_seconds"],
+                "P50 首字节(秒)": row["p50_ttfb_seconds"],
+                "平均重试等待(秒)": row["mean_retry_seconds"],
+                "平均输入 tokens": row["mean_input_tokens"],
+                "平均输出 tokens": row["mean_output_tokens"],
+                "提示词缓存命中": f"{row['prompt_cache_ratio']:.0%}" if row["prompt_cache_ratio"] is not None else "-",
+                "输出 tokens/秒": row["output_tokens_per_second"],
+            } for row in usage_summary]), hide_index=True)
+        else:
+            st.caption("暂无调用记录")
     
     # 2. API 设置
     st.markdown("---")
@@ -1098,6 +1508,7 @@ with st.sidebar:
         st.session_state.selected_provider = selected_provider
 
         config = provider_config[selected_provider]
+        st.session_state.image_budget = get_provider_adapter(selected_provider)["image_budget"]
         
         # 获取保存的设置值
         saved_api_key = st.session_state.get('api_key', '')
@@ -1201,7 +1612,8 @@ with st.sidebar:
                             base_url, 
                             model_name, 
                             [img], 
-                            test_prompt
+                            test_prompt,
+                            use_cache=False
                         )
                         
                         if "error" in response:
@@ -1214,6 +1626,60 @@ with st.sidebar:
                     except Exception as e:
                         st.error(f"测试异常: {str(e)}")
 
+        # 备用服务商：主服务商失败或响应过慢时按顺序接替（对冲请求）
+        st.markdown("---")
+        st.markdown("**🛟 备用服务商（故障转移）**")
+        fallback_providers = st.multiselect(
+            "按优先顺序选择备用服务商",
+            options=[name for name in provider_names if name != selected_provider],
+            default=[name for name in st.session_state.fallback_providers if name != selected_provider],
+            help="主服务商返回错误或无法解析时立即改用下一个；超过对冲阈值仍未返回时，同时向下一个发出请求，先返回可解析结果者胜出"
+        )
+        st.session_state.fallback_providers = fallback_providers
+
+        saved_fallbacks = {entry["provider"]: entry for entry in st.session_state.fallback_chain}
+        fallback_chain = []
+        for name in fallback_providers:
+            fallback_config = provider_config[name]
+            saved = saved_fallbacks.get(name, {})
+            fallback_key = st.text_input(
+                f"{name} · {fallback_config['api_key_label']}",
+                value=saved.get("api_key", ""),
+                type="password",
+                key=f"fallback_key_{name}"
+            )
+            fallback_base_url = st.text_input(
+                f"{name} · Base URL",
+                value=saved.get("base_url", fallback_config["base_url"]),
+                key=f"fallback_base_url_{name}"
+            )
+            fallback_models = fallback_config["models"]
+            fallback_model = st.selectbox(
+                f"{name} · 模型",
+                options=fallback_models,
+                index=fallback_models.index(saved["model"]) if saved.get("model") in fallback_models else 0,
+                key=f"fallback_model_{name}"
+            )
+            if fallback_key:
+                fallback_chain.append({
+                    "provider": name,
+                    "api_key": fallback_key,
+                    "base_url": fallback_base_url,
+                    "model": fallback_model,
+                })
+        st.session_state.fallback_chain = fallback_chain
+
+        if fallback_providers:
+            hedge_after = st.number_input(
+                "对冲等待阈值（秒）",
+                min_value=1,
+                max_value=300,
+                value=int(st.session_state.hedge_after),
+                step=1
+            )
+            st.session_state.hedge_after = hedge_after
+            st.caption("备用服务商的 API Key 只保存在当前会话中；未填写 Key 的备用服务商会被跳过。分组并发识别时只使用主服务商。")
+
 # ==================== 主界面 ====================
 st.markdown("""
 <div style="text-align: center; padding: 1.5rem 0; border-bottom: 1px solid #e5e7eb; margin-bottom: 1.5rem;">
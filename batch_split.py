@@ -0,0 +1,134 @@
+"""
+Bulk recognition and splitting of many textbooks through provider batch
+jobs (OpenAI Batch / Anthropic Message Batches) instead of one synchronous
+call per book. Large manifests are split into as many jobs as the
+provider's per-job size and request-count limits require.
+
+The manifest is a JSON list with one entry per book:
+    [{"pdf": "books/yuwen4a.pdf", "toc_start": 3, "toc_end": 4, "offset": 4}, ...]
+"offset" (PDF page = book page + offset) is detected when omitted.
+Each book is split into <output-dir>/<pdf name>/, next to a toc.json with
+the recognized chapters.
+
+Usage:
+    PDF_SPLITTER_API_KEY=sk-... python batch_split.py manifest.json --prompt-file prompt.md \\
+        --provider OpenAI --model gpt-4o --output-dir out/
+    # offline, against benchmarks/mock_provider.py:
+    PDF_SPLITTER_API_KEY=x python batch_split.py manifest.json --prompt-file prompt.md \\
+        --base-url http://127.0.0.1:8765 --poll-interval 1
+"""
+import argparse
+import json
+import os
+import sys
+
+from pypdf import PdfReader
+
+from core_logic import (
+    PROVIDER_ADAPTERS,
+    ENCODING_PROFILES,
+    BATCH_POLL_INTERVAL,
+    file_sha256,
+    iter_cached_page_files,
+    detect_page_offset,
+    run_vision_batch,
+    parse_vision_response,
+    chapter_page_ranges,
+    split_pdf_with_ranges,
+)
+
+DEFAULT_BASE_URLS = {
+    "OpenAI": "https://api.openai.com/v1",
+    "Anthropic Claude": "https://api.anthropic.com",
+    "阿里通义千问 (Qwen)": "https://dashscope.aliyuncs.com/compatible-mode/v1",
+}
+
+
+def prepare_documents(manifest, image_budget):
+    """
+    Render (or reuse cached) TOC pages and settle the offset of every book.
+    """
+    documents = []
+    for index, entry in enumerate(manifest):
+        pdf_path = entry["pdf"]
+        pages = list(iter_cached_page_files(
+            pdf_path, entry["toc_start"], entry["toc_end"],
+            image_budget=image_budget, pdf_hash=file_sha256(pdf_path)
+        ))
+        offset = entry.get("offset")
+        if offset is None:
+            detection = detect_page_offset(pdf_path)
+            offset = detection["offset"] if detection else 0
+            print(f"{pdf_path}: detected offset {offset} ({detection['source'] if detection else 'default'})")
+        documents.append({
+            "custom_id": f"doc{index:05d}",
+            "pdf": pdf_path,
+            "pages": pages,
+            "offset": offset,
+        })
+    return documents
+
+
+def split_document(document, response, provider, output_dir):
+    """
+    Parse one book's batch result and split the book; returns the file count.
+    """
+    if "error" in response:
+        print(f"{document['pdf']}: recognition failed: {response['error']}")
+        return 0
+    chapters = parse_vision_response(provider, response)
+    if not chapters:
+        print(f"{document['pdf']}: no chapters could be parsed")
+        return 0
+
+    total_pages = len(PdfReader(document["pdf"], strict=False).pages)
+    ranges = chapter_page_ranges(chapters, document["offset"], total_pages)
+    book_dir = os.path.join(output_dir, os.path.splitext(os.path.basename(document["pdf"]))[0])
+    os.makedirs(book_dir, exist_ok=True)
+    with open(os.path.join(book_dir, "toc.json"), "w", encoding="utf-8") as f:
+        json.dump(chapters, f, ensure_ascii=False, indent=2)
+    files = split_pdf_with_ranges(document["pdf"], ranges, book_dir)
+    print(f"{document['pdf']}: {len(chapters)} chapters, {len(files)} files")
+    return len(files)
+
+
+def main():
+    batch_providers = [name for name, adapter in PROVIDER_ADAPTERS.items() if adapter["run_batch"]]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest")
+    parser.add_argument("--prompt-file", required=True, help="recognition prompt (e.g. the one from the app's prompt editor)")
+    parser.add_argument("--provider", default="OpenAI", choices=batch_providers)
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--base-url")
+    parser.add_argument("--encoding-profile", default="original", choices=list(ENCODING_PROFILES.keys()))
+    parser.add_argument("--poll-interval", type=float, default=BATCH_POLL_INTERVAL)
+    parser.add_argument("--output-dir", default="batch_output")
+    args = parser.parse_args()
+
+    api_key = os.environ.get("PDF_SPLITTER_API_KEY")
+    if not api_key:
+        sys.exit("Set PDF_SPLITTER_API_KEY")
+    with open(args.prompt_file, encoding="utf-8") as f:
+        prompt = f.read()
+    with open(args.manifest, encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    image_budget = PROVIDER_ADAPTERS[args.provider]["image_budget"]
+    documents = prepare_documents(manifest, image_budget)
+    results = run_vision_batch(
+        args.provider, api_key, args.base_url or DEFAULT_BASE_URLS[args.provider], args.model,
+        [{"custom_id": doc["custom_id"], "images": doc["pages"], "prompt": prompt} for doc in documents],
+        image_budget=image_budget,
+        encoding_profile=args.encoding_profile,
+        poll_interval=args.poll_interval,
+    )
+
+    split_books = 0
+    for document in documents:
+        if split_document(document, results[document["custom_id"]], args.provider, args.output_dir):
+            split_books += 1
+    print(f"\nSplit {split_books}/{len(documents)} books into {os.path.abspath(args.output_dir)}")
+
+
+if __name__ == "__main__":
+    main()
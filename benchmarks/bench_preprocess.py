@@ -0,0 +1,58 @@
+"""
+Benchmark: payload bytes (and optionally provider latency) with and without
+scan preprocessing (margin crop, deskew, binarization).
+
+Usage:
+    python benchmarks/bench_preprocess.py samples/*.jpg --profile jpeg_gray
+    PDF_SPLITTER_API_KEY=sk-... python benchmarks/bench_preprocess.py samples/*.jpg \\
+        --provider OpenAI --base-url https://api.openai.com/v1 --model gpt-4o
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core_logic import ENCODING_PROFILES, call_vision_api, encode_image, with_preprocessing
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the effect of scan preprocessing")
+    parser.add_argument("images", nargs="+", help="sample TOC page images")
+    parser.add_argument("--profile", default="jpeg_gray", choices=list(ENCODING_PROFILES.keys()))
+    parser.add_argument("--provider")
+    parser.add_argument("--base-url")
+    parser.add_argument("--model")
+    args = parser.parse_args()
+
+    plain_profile = args.profile
+    cleaned_profile = with_preprocessing(args.profile)
+
+    plain_total = cleaned_total = 0
+    start = time.perf_counter()
+    for path in args.images:
+        plain = len(encode_image(path, plain_profile))
+        cleaned = len(encode_image(path, cleaned_profile))
+        plain_total += plain
+        cleaned_total += cleaned
+        print(f"{os.path.basename(path)}: {plain} -> {cleaned} base64 bytes ({cleaned / plain:.0%})")
+    elapsed = time.perf_counter() - start
+
+    print(f"\nTotal ({len(args.images)} pages, profile {args.profile}): "
+          f"{plain_total / 1024:.1f} KB -> {cleaned_total / 1024:.1f} KB "
+          f"({1 - cleaned_total / max(plain_total, 1):.0%} smaller), encode time {elapsed:.2f}s")
+
+    api_key = os.environ.get("PDF_SPLITTER_API_KEY")
+    if args.provider and api_key:
+        prompt = "Reply with the chapter titles you can read, as a JSON array of strings."
+        for label, profile in (("plain", plain_profile), ("preprocessed", cleaned_profile)):
+            start = time.perf_counter()
+            response = call_vision_api(args.provider, api_key, args.base_url, args.model, args.images, prompt,
+                                       encoding_profile=profile, use_cache=False)
+            status = "error" if "error" in response else "ok"
+            print(f"Provider latency [{label}]: {time.perf_counter() - start:.2f}s ({status})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark: the recognition path (call_vision_api -> parser -> split) against
+the local mock provider, with no API quota involved.
+
+Fires --requests recognitions at --concurrency and reports latency
+percentiles, failures and parse success; with --pdf the parsed chapters of
+the last successful response are also split into files.
+
+Usage:
+    python benchmarks/bench_recognition.py --provider "Anthropic Claude" --requests 40 --concurrency 8 \\
+        --latency 1.0 --latency-sigma 0.5 --rate-limit-rate 0.1 --truncate-rate 0.05 --stream
+    python benchmarks/bench_recognition.py --pdf book.pdf --offset 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Keep mock calls out of the real caches and usage log (core_logic reads this on import)
+_cache_dir = tempfile.TemporaryDirectory(prefix="bench_recognition_")
+os.environ["PDF_SPLITTER_CACHE_DIR"] = _cache_dir.name
+
+from core_logic import PROVIDER_ADAPTERS, call_vision_api, parse_vision_response, split_pdf, summarize_vision_calls
+from mock_provider import start_mock_provider
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, -(-q * len(ordered) // 100) - 1))]
+
+
+def recognize_once(args, base_url, images):
+    chapters_seen = []
+    start = time.perf_counter()
+    response = call_vision_api(
+        args.provider, "mock-key", base_url, "mock-model", images, "Extract the TOC as a JSON array.",
+        use_cache=False, on_chapter=chapters_seen.append if args.stream else None
+    )
+    elapsed = time.perf_counter() - start
+    if "error" in response:
+        return elapsed, None, response["error"]
+    chapters = parse_vision_response(args.provider, response) or chapters_seen
+    return elapsed, chapters, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the recognition path against the mock provider")
+    parser.add_argument("--provider", default="OpenAI", choices=list(PROVIDER_ADAPTERS.keys()))
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=2, help="images per request")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--latency-sigma", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--truncate-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--pdf", help="split this PDF with the recognized chapters")
+    parser.add_argument("--offset", type=int, default=0)
+    args = parser.parse_args()
+
+    server = start_mock_provider(
+        latency=args.latency, latency_sigma=args.latency_sigma, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, truncate_rate=args.truncate_rate, seed=args.seed
+    )
+    # The mock routes on the path suffix, so one base URL serves every provider
+    base_url = server.base_url
+    images = [Image.new("L", (1200, 1600), color=255) for _ in range(args.pages)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda _: recognize_once(args, base_url, images), range(args.requests)))
+    wall = time.perf_counter() - start
+    server.shutdown()
+
+    latencies = [elapsed for elapsed, _, _ in results]
+    failures = [error for _, _, error in results if error]
+    parsed = [chapters for _, chapters, _ in results if chapters]
+    print(f"{args.provider}: {args.requests} requests, concurrency {args.concurrency}, stream={args.stream}")
+    print(f"Server outcomes: {server.counts}")
+    print(f"Wall time {wall:.2f}s; end-to-end latency (retries included) p50 {percentile(latencies, 50):.2f}s, "
+          f"p90 {percentile(latencies, 90):.2f}s, p99 {percentile(latencies, 99):.2f}s")
+    for row in summarize_vision_calls():
+        print(f"Provider calls (usage log, retries excluded): {row['calls']} calls, p50 {row['p50_seconds']:.2f}s, "
+              f"p90 {row['p90_seconds']:.2f}s, mean retry wait {row['mean_retry_seconds'] or 0:.2f}s")
+    print(f"Failed calls: {len(failures)}; parsed results: {len(parsed)}/{args.requests - len(failures)}")
+    if parsed:
+        print(f"Chapters per parsed result: min {min(map(len, parsed))}, max {max(map(len, parsed))}")
+
+    if args.pdf and parsed:
+        with tempfile.TemporaryDirectory() as out_dir:
+            files = split_pdf(args.pdf, parsed[-1], args.offset, out_dir)
+            print(f"Split {args.pdf} into {len(files)} files")
+
+
+if __name__ == "__main__":
+    main()
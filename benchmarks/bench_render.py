@@ -0,0 +1,49 @@
+"""
+Benchmark: serial vs parallel page rendering.
+
+Usage:
+    python benchmarks/bench_render.py book.pdf --first 1 --last 10 --workers 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core_logic import iter_pdf_page_files, RENDER_WORKERS
+
+
+def time_render(pdf_path, first_page, last_page, workers, dpi, repeat):
+    timings = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as out_dir:
+            start = time.perf_counter()
+            pages = list(iter_pdf_page_files(pdf_path, first_page, last_page, out_dir, dpi=dpi, workers=workers))
+            timings.append(time.perf_counter() - start)
+    return min(timings), len(pages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare serial and parallel PDF page rendering")
+    parser.add_argument("pdf")
+    parser.add_argument("--first", type=int, default=1)
+    parser.add_argument("--last", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=RENDER_WORKERS)
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    serial, pages = time_render(args.pdf, args.first, args.last, 1, args.dpi, args.repeat)
+    parallel, _ = time_render(args.pdf, args.first, args.last, args.workers, args.dpi, args.repeat)
+
+    print(f"Pages rendered: {pages} @ {args.dpi} DPI (best of {args.repeat})")
+    print(f"Serial (1 worker):      {serial:.2f}s")
+    print(f"Parallel ({args.workers} workers): {parallel:.2f}s")
+    if parallel > 0:
+        print(f"Speedup:                {serial / parallel:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
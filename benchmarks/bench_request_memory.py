@@ -0,0 +1,108 @@
+"""
+Benchmark: peak memory of building and sending a vision request body (tracemalloc).
+
+Compares what requests.post(json=payload) does (serialize the whole payload
+to str, then encode to bytes) with StreamingJSONBody, which streams the JSON
+framing around the already encoded base64 images. The streaming body is also
+sent through http_post to the mock provider (run as a subprocess, so only the
+client's allocations are traced), and the send peak must stay within about
+one encoded image; the script exits non-zero when it doesn't.
+
+Usage:
+    python benchmarks/bench_request_memory.py --images 10 --image-mb 4
+"""
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core_logic import StreamingJSONBody, image_placeholder, http_post
+
+
+def build_payload(image_count, data_for):
+    content = [{"type": "text", "text": "prompt"}]
+    for i in range(image_count):
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{data_for(i)}"}})
+    return {"model": "m", "messages": [{"role": "user", "content": content}], "max_tokens": 8192}
+
+
+def peak_json_kwarg(encoded_images):
+    tracemalloc.start()
+    payload = build_payload(len(encoded_images), lambda i: encoded_images[i])
+    # requests: complexjson.dumps(json, allow_nan=False).encode("utf-8")
+    body = json.dumps(payload, allow_nan=False).encode("utf-8")
+    sent = len(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, sent
+
+
+def peak_streaming(encoded_images):
+    tracemalloc.start()
+    payload = build_payload(len(encoded_images), image_placeholder)
+    sent = 0
+    for chunk in StreamingJSONBody(payload, encoded_images):
+        sent += len(chunk)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, sent
+
+
+def peak_send(encoded_images, base_url):
+    payload = build_payload(len(encoded_images), image_placeholder)
+    tracemalloc.start()
+    response = http_post(f"{base_url}/chat/completions", {"Content-Type": "application/json"},
+                         StreamingJSONBody(payload, encoded_images))
+    response.raise_for_status()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def start_mock_provider_process():
+    mock = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_provider.py")
+    process = subprocess.Popen([sys.executable, "-u", mock, "--port", "0", "--latency", "0"],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    # "Mock provider listening on http://127.0.0.1:PORT (...)"
+    base_url = process.stdout.readline().split()[4]
+    return process, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory of request body construction")
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--image-mb", type=float, default=4.0, help="raw JPEG size per page")
+    args = parser.parse_args()
+
+    raw = os.urandom(int(args.image_mb * 1024 * 1024))
+    # The encoded images exist before either path runs (encode cache); not counted
+    encoded_images = [base64.b64encode(raw).decode("utf-8") for _ in range(args.images)]
+    payload_mb = sum(len(b) for b in encoded_images) / 1024 ** 2
+
+    json_peak, json_sent = peak_json_kwarg(encoded_images)
+    stream_peak, stream_sent = peak_streaming(encoded_images)
+
+    print(f"Encoded images: {args.images} x {args.image_mb} MB raw = {payload_mb:.1f} MB base64")
+    print(f"requests json=:       peak {json_peak / 1024 ** 2:.1f} MB extra ({json_sent} bytes sent)")
+    print(f"StreamingJSONBody:    peak {stream_peak / 1024 ** 2:.1f} MB extra ({stream_sent} bytes sent)")
+
+    process, base_url = start_mock_provider_process()
+    try:
+        send_peak = peak_send(encoded_images, base_url)
+    finally:
+        process.terminate()
+        process.wait()
+    # One image's bytes may be in flight at a time, plus JSON framing and HTTP buffers
+    bound = 1.5 * max(len(b) for b in encoded_images) + 1024 ** 2
+    print(f"http_post (streamed): peak {send_peak / 1024 ** 2:.1f} MB extra (bound {bound / 1024 ** 2:.1f} MB)")
+    if send_peak > bound:
+        sys.exit("FAIL: sending the request held more than one encoded image in memory")
+
+
+if __name__ == "__main__":
+    main()
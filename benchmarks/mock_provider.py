@@ -0,0 +1,531 @@
+"""
+Local stand-in for the vision providers, for offline load and latency tests.
+
+Speaks the three wire formats call_vision_api uses, streaming included:
+    OpenAI-compatible   POST .../chat/completions
+    Claude              POST .../v1/messages
+    Gemini              POST .../models/<model>:generateContent
+                        POST .../models/<model>:streamGenerateContent?alt=sse
+plus the batch APIs used by run_vision_batch:
+    OpenAI Batch        POST .../files, POST .../batches, GET .../batches/<id>,
+                        GET .../files/<id>/content
+    Claude batches      POST .../v1/messages/batches, GET .../v1/messages/batches/<id>[/results]
+and answers every request with a canned TOC. Latency (lognormal around a
+median), error and 429 rates and truncated outputs are configurable, and
+--seed makes the sequence of outcomes reproducible. A leading text block
+seen before is reported as a prompt-cache read, the way the providers do,
+a request quoting a TOC entry (a continuation of a truncated output)
+gets only the entries after it, and schema-constrained requests
+(response_format, responseSchema, Claude tools) get bare JSON or a tool call.
+
+Usage:
+    python benchmarks/mock_provider.py --port 8765 --latency 1.5 --latency-sigma 0.4 --rate-limit-rate 0.1
+    then set the sidebar Base URL to http://127.0.0.1:8765 (any provider, any key)
+"""
+import argparse
+import email
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_TOC = [
+    {"title": "第一单元 导读", "page": 1, "type": "导读", "filename": "01_导读_第一单元"},
+    {"title": "1 观潮", "page": 2, "type": "课题", "filename": "02_课题_观潮"},
+    {"title": "2 走月亮", "page": 6, "type": "课题", "filename": "03_课题_走月亮"},
+    {"title": "3 现代诗二首", "page": 10, "type": "课题", "filename": "04_课题_现代诗二首"},
+    {"title": "4 繁星", "page": 14, "type": "课题", "filename": "05_课题_繁星"},
+    {"title": "习作 推荐一个好地方", "page": 18, "type": "习作", "filename": "06_习作_推荐一个好地方"},
+    {"title": "第二单元 导读", "page": 21, "type": "导读", "filename": "07_导读_第二单元"},
+    {"title": "5 一个豆荚里的五粒豆", "page": 22, "type": "课题", "filename": "08_课题_一个豆荚里的五粒豆"},
+    {"title": "6 夜间飞行的秘密", "page": 27, "type": "课题", "filename": "09_课题_夜间飞行的秘密"},
+    {"title": "7 呼风唤雨的世纪", "page": 31, "type": "课题", "filename": "10_课题_呼风唤雨的世纪"},
+    {"title": "8 蝴蝶的家", "page": 35, "type": "课题", "filename": "11_课题_蝴蝶的家"},
+    {"title": "语文园地", "page": 39, "type": "习题", "filename": "12_习题_语文园地"},
+]
+
+DEFAULT_CONFIG = {
+    "toc": DEFAULT_TOC,
+    "latency": 0.5,           # median seconds before the first byte
+    "latency_sigma": 0.0,     # lognormal spread; 0 = fixed latency
+    "error_rate": 0.0,        # share of 500 responses
+    "rate_limit_rate": 0.0,   # share of 429 responses
+    "retry_after": 1,         # Retry-After seconds sent with 429
+    "truncate_rate": 0.0,     # share of outputs cut off mid-array (max tokens)
+    "chunk_chars": 24,        # characters per streamed delta
+    "chunk_delay": 0.02,      # seconds between streamed deltas
+    "batch_latency": 2.0,     # seconds until a batch job has finished
+    "seed": None,
+}
+
+_GEMINI_PATH_RE = re.compile(r'/models/([^/:]+):(generateContent|streamGenerateContent)')
+_OPENAI_BATCH_RE = re.compile(r'/batches/([^/]+)$')
+_OPENAI_FILE_RE = re.compile(r'/files/([^/]+)/content$')
+_CLAUDE_BATCH_RE = re.compile(r'/v1/messages/batches/([^/]+)(/results)?$')
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        path = self.path.split("?")[0]
+        if path.endswith("/files"):
+            self._send_json(200, self.server.store_file(_multipart_file(self.headers.get("Content-Type", ""), raw)))
+            return
+        try:
+            request = json.loads(raw or b"{}")
+        except ValueError:
+            request = {}
+
+        if path.endswith("/v1/messages/batches"):
+            self._send_json(200, self.server.create_claude_batch(request["requests"]))
+            return
+        if path.endswith("/batches"):
+            self._send_json(200, self.server.create_openai_batch(request))
+            return
+        if path.endswith("/chat/completions"):
+            protocol, stream = "openai", bool(request.get("stream"))
+        elif path.endswith("/v1/messages"):
+            protocol, stream = "claude", bool(request.get("stream"))
+        elif _GEMINI_PATH_RE.search(path):
+            protocol, stream = "gemini", "streamGenerateContent" in path
+        else:
+            self._send_json(404, {"error": {"message": f"unknown endpoint {path}"}})
+            return
+
+        outcome, latency, truncated = self.server.draw_outcome()
+        self.server.count(outcome)
+        time.sleep(latency)
+
+        if outcome == "rate_limited":
+            self._send_error(protocol, 429, "rate limit exceeded", {"Retry-After": str(self.server.config["retry_after"])})
+            return
+        if outcome == "error":
+            self._send_error(protocol, 500, "internal error")
+            return
+
+        text, usage = self.server.completion(protocol, request, truncated)
+        if stream:
+            self._send_stream(protocol, request, text, usage, truncated)
+        else:
+            self._send_json(200, _response_body(protocol, request, text, usage, truncated))
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        claude_batch = _CLAUDE_BATCH_RE.search(path)
+        openai_batch = _OPENAI_BATCH_RE.search(path)
+        openai_file = _OPENAI_FILE_RE.search(path)
+        if claude_batch and claude_batch.group(2):
+            self._send_text(self.server.claude_batch_results(claude_batch.group(1)))
+        elif claude_batch:
+            self._send_json(200, self.server.claude_batch_status(claude_batch.group(1), self._base_url()))
+        elif openai_batch:
+            self._send_json(200, self.server.openai_batch_status(openai_batch.group(1)))
+        elif openai_file:
+            self._send_text(self.server.files.get(openai_file.group(1), ""))
+        else:
+            self._send_json(404, {"error": {"message": f"unknown endpoint {path}"}})
+
+    def _base_url(self):
+        return f"http://{self.headers.get('Host')}"
+
+    def _send_text(self, text):
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/jsonl")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, status, body, extra_headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, protocol, status, message, extra_headers=None):
+        if protocol == "claude":
+            kind = "rate_limit_error" if status == 429 else "api_error"
+            body = {"type": "error", "error": {"type": kind, "message": message}}
+        elif protocol == "gemini":
+            body = {"error": {"code": status, "message": message, "status": "RESOURCE_EXHAUSTED" if status == 429 else "INTERNAL"}}
+        else:
+            body = {"error": {"message": message, "type": "rate_limit_exceeded" if status == 429 else "server_error"}}
+        self._send_json(status, body, extra_headers)
+
+    def _send_stream(self, protocol, request, text, usage, truncated):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(event, name=None):
+            data = (f"event: {name}\n" if name else "") + f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            self._write_chunk(data.encode("utf-8"))
+
+        chunk_chars = self.server.config["chunk_chars"]
+        pieces = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        if protocol == "claude":
+            send({"type": "message_start", "message": {"model": request.get("model"), "usage": dict(_wire_usage(protocol, usage), output_tokens=1)}}, "message_start")
+            tool_use = _structured(protocol, request)
+            block = dict(_claude_tool_use(request, "{}", False), input={}) if tool_use else {"type": "text", "text": ""}
+            send({"type": "content_block_start", "index": 0, "content_block": block}, "content_block_start")
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(self.server.config["chunk_delay"])
+            if protocol == "openai":
+                send({"choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+            elif protocol == "claude":
+                delta = {"type": "input_json_delta", "partial_json": piece} if tool_use else {"type": "text_delta", "text": piece}
+                send({"type": "content_block_delta", "index": 0, "delta": delta}, "content_block_delta")
+            else:
+                send({"candidates": [{"content": {"parts": [{"text": piece}], "role": "model"}}]})
+
+        if protocol == "openai":
+            send({"choices": [{"index": 0, "delta": {}, "finish_reason": "length" if truncated else "stop"}]})
+            if (request.get("stream_options") or {}).get("include_usage"):
+                send({"choices": [], "usage": _wire_usage(protocol, usage)})
+            self._write_chunk(b"data: [DONE]\n\n")
+        elif protocol == "claude":
+            send({"type": "content_block_stop", "index": 0}, "content_block_stop")
+            stop_reason = "max_tokens" if truncated else ("tool_use" if tool_use else "end_turn")
+            send({"type": "message_delta", "delta": {"stop_reason": stop_reason}, "usage": {"output_tokens": usage["output_tokens"]}}, "message_delta")
+            send({"type": "message_stop"}, "message_stop")
+        else:
+            send({"candidates": [{"content": {"parts": [{"text": ""}], "role": "model"}, "finishReason": "MAX_TOKENS" if truncated else "STOP"}],
+                  "usageMetadata": _wire_usage(protocol, usage)})
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def _multipart_file(content_type, raw):
+    """
+    Content of the 'file' field of a multipart/form-data upload.
+    """
+    message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + raw)
+    for part in message.get_payload():
+        if part.get_param("name", header="content-disposition") == "file":
+            return part.get_payload(decode=True).decode("utf-8")
+    return ""
+
+
+def _prompt_prefix(protocol, request):
+    """
+    The first text block of a request: the prompt-cache prefix. Claude only
+    caches up to an explicit cache_control breakpoint.
+    """
+    if protocol == "gemini":
+        parts = [part for content in request.get("contents", []) for part in content.get("parts", [])]
+        return parts[0].get("text") if parts else None
+    items = [item for message in request.get("messages", []) for item in (message.get("content") or [])
+             if isinstance(item, dict)]
+    if not items or items[0].get("type") != "text":
+        return None
+    if protocol == "claude" and "cache_control" not in items[0]:
+        return None
+    return items[0]["text"]
+
+
+def _wire_usage(protocol, usage):
+    """
+    Usage in each provider's field names; Claude's input_tokens exclude cache reads.
+    """
+    cached = usage["cached_input_tokens"]
+    if protocol == "claude":
+        return {"input_tokens": usage["input_tokens"] - cached, "cache_read_input_tokens": cached,
+                "cache_creation_input_tokens": 0, "output_tokens": usage["output_tokens"]}
+    if protocol == "gemini":
+        return {"promptTokenCount": usage["input_tokens"], "candidatesTokenCount": usage["output_tokens"],
+                "cachedContentTokenCount": cached}
+    return {"prompt_tokens": usage["input_tokens"], "completion_tokens": usage["output_tokens"],
+            "prompt_tokens_details": {"cached_tokens": cached}}
+
+
+def _request_content(protocol, request):
+    """
+    (text blocks, image count) of a request.
+    """
+    if protocol == "gemini":
+        parts = [part for content in request.get("contents", []) for part in content.get("parts", [])]
+        return [part.get("text", "") for part in parts if "text" in part], sum(1 for part in parts if "inline_data" in part)
+    items = [item for message in request.get("messages", []) for item in (message.get("content") or [])
+             if isinstance(item, dict)]
+    texts = [item.get("text", "") for item in items if item.get("type") == "text"]
+    return texts, sum(1 for item in items if item.get("type") in ("image", "image_url"))
+
+
+def _estimate_input_tokens(protocol, request):
+    """
+    Rough prompt size: ~1 token per 2 characters of text plus ~1000 per image.
+    """
+    texts, images = _request_content(protocol, request)
+    return sum(len(text) for text in texts) // 2 + 1000 * images
+
+
+def _structured(protocol, request):
+    """
+    Whether the request asks for schema-constrained output.
+    """
+    if protocol == "gemini":
+        return "responseSchema" in (request.get("generationConfig") or {})
+    if protocol == "claude":
+        return bool(request.get("tools"))
+    return (request.get("response_format") or {}).get("type") == "json_schema"
+
+
+def _remaining_toc(toc, protocol, request):
+    """
+    The entries after the last one quoted in the request: a continuation of a
+    truncated output asks only for the tail.
+    """
+    prompt = "\n".join(_request_content(protocol, request)[0])
+    quoted = [i for i, entry in enumerate(toc) if json.dumps(entry, ensure_ascii=False) in prompt]
+    return toc[quoted[-1] + 1:] if quoted else toc
+
+
+def _claude_tool_use(request, text, truncated):
+    """
+    The forced tool call carrying a structured Claude answer; a tool input cut
+    off at max_tokens is unusable, as with the real API.
+    """
+    return {"type": "tool_use", "id": "toolu_mock", "name": request["tools"][0]["name"],
+            "input": {} if truncated else json.loads(text)}
+
+
+def _response_body(protocol, request, text, usage, truncated):
+    if protocol == "claude":
+        tool_use = _structured(protocol, request)
+        return {
+            "type": "message", "role": "assistant", "model": request.get("model"),
+            "content": [_claude_tool_use(request, text, truncated) if tool_use else {"type": "text", "text": text}],
+            "stop_reason": "max_tokens" if truncated else ("tool_use" if tool_use else "end_turn"),
+            "usage": _wire_usage(protocol, usage),
+        }
+    if protocol == "gemini":
+        return {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "MAX_TOKENS" if truncated else "STOP"}],
+            "usageMetadata": _wire_usage(protocol, usage),
+        }
+    return {
+        "object": "chat.completion", "model": request.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "length" if truncated else "stop"}],
+        "usage": _wire_usage(protocol, usage),
+    }
+
+
+class MockProviderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config=None, quiet=True):
+        super().__init__(address, MockProviderHandler)
+        self.config = dict(DEFAULT_CONFIG, **(config or {}))
+        self.quiet = quiet
+        self._rng = random.Random(self.config["seed"])
+        self._lock = threading.Lock()
+        self.counts = {"ok": 0, "error": 0, "rate_limited": 0}
+        self.files = {}
+        self.batches = {}
+        self.prompt_prefixes = set()
+        self._last_id = 0
+
+    def handle_error(self, request, client_address):
+        # Clients dropping a connection (e.g. after a 429) are expected here
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def draw_outcome(self):
+        """
+        Outcome, latency and truncation of one request, drawn from the seeded RNG.
+        """
+        config = self.config
+        with self._lock:
+            roll = self._rng.random()
+            latency = config["latency"] * math.exp(config["latency_sigma"] * self._rng.gauss(0, 1)) if config["latency_sigma"] else config["latency"]
+            truncated = self._rng.random() < config["truncate_rate"]
+        if roll < config["rate_limit_rate"]:
+            return "rate_limited", latency, False
+        if roll < config["rate_limit_rate"] + config["error_rate"]:
+            return "error", latency, False
+        return "ok", latency, truncated
+
+    def completion(self, protocol, request, truncated):
+        """
+        Canned TOC answer (cut short when truncated) and its token usage.
+        """
+        prefix = _prompt_prefix(protocol, request)
+        with self._lock:
+            cached = prefix is not None and prefix in self.prompt_prefixes
+            if prefix is not None:
+                self.prompt_prefixes.add(prefix)
+        toc = _remaining_toc(self.config["toc"], protocol, request)
+        structured = _structured(protocol, request)
+        # Schema-constrained answers are bare JSON; OpenAI and Claude wrap the array in an object
+        answer = {"chapters": toc} if structured and protocol != "gemini" else toc
+        text = json.dumps(answer, ensure_ascii=False, indent=1)
+        if truncated:
+            text = text[:int(len(text) * self.rng_uniform(0.4, 0.9))]
+        if not structured:
+            text = f"```json\n{text}" + ("" if truncated else "\n```")
+        return text, {"input_tokens": _estimate_input_tokens(protocol, request), "output_tokens": max(1, len(text) // 2),
+                      "cached_input_tokens": len(prefix) // 2 if cached else 0}
+
+    def _batch_result(self, protocol, request):
+        """
+        (response body, None) or (None, error) for one batched request.
+        """
+        outcome, _, truncated = self.draw_outcome()
+        self.count(outcome)
+        if outcome != "ok":
+            return None, {"type": "rate_limit_error" if outcome == "rate_limited" else "api_error", "message": outcome}
+        text, usage = self.completion(protocol, request, truncated)
+        return _response_body(protocol, request, text, usage, truncated), None
+
+    def _new_id(self, prefix):
+        with self._lock:
+            self._last_id += 1
+            return f"{prefix}_{self._last_id:04d}"
+
+    def store_file(self, content):
+        file_id = self._new_id("file")
+        self.files[file_id] = content
+        return {"id": file_id, "object": "file", "purpose": "batch", "bytes": len(content)}
+
+    def create_openai_batch(self, request):
+        batch_id = self._new_id("batch")
+        lines = [json.loads(line) for line in self.files.get(request.get("input_file_id"), "").splitlines() if line.strip()]
+        self.batches[batch_id] = {"kind": "openai", "lines": lines, "ready_at": time.time() + self.config["batch_latency"], "status": None}
+        return self.openai_batch_status(batch_id)
+
+    def openai_batch_status(self, batch_id):
+        batch = self.batches[batch_id]
+        status = {"id": batch_id, "object": "batch", "endpoint": "/v1/chat/completions",
+                  "request_counts": {"total": len(batch["lines"]), "completed": 0, "failed": 0}}
+        if time.time() < batch["ready_at"]:
+            return dict(status, status="in_progress")
+        if batch["status"] is None:
+            output, errors = [], []
+            for line in batch["lines"]:
+                body, error = self._batch_result("openai", line["body"])
+                if error:
+                    errors.append({"id": f"req_{line['custom_id']}", "custom_id": line["custom_id"],
+                                   "response": {"status_code": 429 if error["type"] == "rate_limit_error" else 500, "body": {"error": error}}, "error": None})
+                else:
+                    output.append({"id": f"req_{line['custom_id']}", "custom_id": line["custom_id"],
+                                   "response": {"status_code": 200, "body": body}, "error": None})
+            batch["status"] = dict(status, status="completed", request_counts={"total": len(batch["lines"]), "completed": len(output), "failed": len(errors)})
+            batch["status"]["output_file_id"] = self.store_file("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in output))["id"]
+            if errors:
+                batch["status"]["error_file_id"] = self.store_file("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in errors))["id"]
+        return batch["status"]
+
+    def create_claude_batch(self, requests_):
+        batch_id = self._new_id("msgbatch")
+        self.batches[batch_id] = {"kind": "claude", "requests": requests_, "ready_at": time.time() + self.config["batch_latency"], "results": None}
+        return {"id": batch_id, "type": "message_batch", "processing_status": "in_progress",
+                "request_counts": {"processing": len(requests_), "succeeded": 0, "errored": 0}}
+
+    def claude_batch_status(self, batch_id, base_url):
+        batch = self.batches[batch_id]
+        if time.time() < batch["ready_at"]:
+            return {"id": batch_id, "type": "message_batch", "processing_status": "in_progress",
+                    "request_counts": {"processing": len(batch["requests"]), "succeeded": 0, "errored": 0}}
+        if batch["results"] is None:
+            batch["results"] = []
+            for request in batch["requests"]:
+                body, error = self._batch_result("claude", request["params"])
+                result = {"type": "errored", "error": {"type": "error", "error": error}} if error else {"type": "succeeded", "message": body}
+                batch["results"].append({"custom_id": request["custom_id"], "result": result})
+        succeeded = sum(1 for r in batch["results"] if r["result"]["type"] == "succeeded")
+        return {"id": batch_id, "type": "message_batch", "processing_status": "ended",
+                "request_counts": {"processing": 0, "succeeded": succeeded, "errored": len(batch["results"]) - succeeded},
+                "results_url": f"{base_url}/v1/messages/batches/{batch_id}/results"}
+
+    def claude_batch_results(self, batch_id):
+        return "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in self.batches[batch_id]["results"] or [])
+
+    def rng_uniform(self, low, high):
+        with self._lock:
+            return self._rng.uniform(low, high)
+
+    def count(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+
+def start_mock_provider(port=0, host="127.0.0.1", quiet=True, **config):
+    """
+    Start the mock server on a background thread; returns the server
+    (use server.base_url as base_url, server.shutdown() to stop it).
+    """
+    server = MockProviderServer((host, port), config, quiet=quiet)
+    threading.Thread(target=server.serve_forever, name="mock-provider", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--toc", help="JSON file with the chapter list to return (default: built-in sample)")
+    parser.add_argument("--latency", type=float, default=DEFAULT_CONFIG["latency"], help="median seconds before the first byte")
+    parser.add_argument("--latency-sigma", type=float, default=DEFAULT_CONFIG["latency_sigma"], help="lognormal spread of the latency (0 = fixed)")
+    parser.add_argument("--error-rate", type=float, default=DEFAULT_CONFIG["error_rate"])
+    parser.add_argument("--rate-limit-rate", type=float, default=DEFAULT_CONFIG["rate_limit_rate"])
+    parser.add_argument("--retry-after", type=int, default=DEFAULT_CONFIG["retry_after"])
+    parser.add_argument("--truncate-rate", type=float, default=DEFAULT_CONFIG["truncate_rate"])
+    parser.add_argument("--chunk-delay", type=float, default=DEFAULT_CONFIG["chunk_delay"], help="seconds between streamed deltas")
+    parser.add_argument("--batch-latency", type=float, default=DEFAULT_CONFIG["batch_latency"], help="seconds until a batch job has finished")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    config = {
+        "latency": args.latency,
+        "latency_sigma": args.latency_sigma,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "retry_after": args.retry_after,
+        "truncate_rate": args.truncate_rate,
+        "chunk_delay": args.chunk_delay,
+        "batch_latency": args.batch_latency,
+        "seed": args.seed,
+    }
+    if args.toc:
+        with open(args.toc, encoding="utf-8") as f:
+            config["toc"] = json.load(f)
+
+    server = MockProviderServer((args.host, args.port), config, quiet=False)
+    print(f"Mock provider listening on {server.base_url} (OpenAI: {server.base_url}/v1)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Outcomes: {server.counts}")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
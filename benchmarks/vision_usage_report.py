@@ -0,0 +1,69 @@
+"""
+Report: per provider/model latency percentiles, token usage and prompt-cache
+hit share of logged vision calls (the usage log lives next to the caches,
+see USAGE_LOG_PATH).
+
+Usage:
+    python benchmarks/vision_usage_report.py --days 7
+    python benchmarks/vision_usage_report.py --calls 20 --provider OpenAI
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core_logic import USAGE_LOG_PATH, query_vision_calls, summarize_vision_calls
+
+
+def fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def print_summary(since):
+    rows = summarize_vision_calls(since=since)
+    if not rows:
+        print("No calls logged.")
+        return
+    print(f"{'provider/model':<40} {'calls':>5} {'cache':>5} {'err':>4} {'parse':>6} "
+          f"{'p50 s':>7} {'p90 s':>7} {'p99 s':>7} {'ttfb50':>7} {'retry':>6} {'in tok':>8} {'cached':>6} {'out tok':>8} {'out/s':>7}")
+    for row in rows:
+        name = f"{row['provider']}/{row['model']}"
+        print(f"{name[:40]:<40} {row['calls']:>5} {row['cached']:>5} {row['errors']:>4} "
+              f"{fmt(row['parse_rate'], '.0%'):>6} {fmt(row['p50_seconds'], '.2f'):>7} "
+              f"{fmt(row['p90_seconds'], '.2f'):>7} {fmt(row['p99_seconds'], '.2f'):>7} "
+              f"{fmt(row['p50_ttfb_seconds'], '.2f'):>7} {fmt(row['mean_retry_seconds'], '.2f'):>6} "
+              f"{fmt(row['mean_input_tokens'], '.0f'):>8} "
+              f"{fmt(row['prompt_cache_ratio'], '.0%'):>6} {fmt(row['mean_output_tokens'], '.0f'):>8} "
+              f"{fmt(row['output_tokens_per_second'], '.1f'):>7}")
+
+
+def print_calls(since, provider, model, limit):
+    for call in query_vision_calls(since=since, provider=provider, model=model, limit=limit):
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(call["ts"]))
+        print(f"{stamp} {call['provider']}/{call['model']} {call['status']:<6} images={call['images']} "
+              f"bytes={call['payload_bytes']} ttfb={fmt(call['ttfb_seconds'], '.2f')} "
+              f"total={call['total_seconds']:.2f} retry={fmt(call['retry_seconds'], '.2f')} tokens={call['input_tokens']}/{call['output_tokens']} "
+              f"cached={call['cached_input_tokens']} "
+              f"chapters={call['parsed_chapters']}" + (f" error={call['error']}" if call["error"] else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=float, default=7, help="only calls from the last N days")
+    parser.add_argument("--calls", type=int, default=0, help="also list the N most recent calls")
+    parser.add_argument("--provider")
+    parser.add_argument("--model")
+    args = parser.parse_args()
+
+    since = time.time() - args.days * 86400
+    print(f"Usage log: {USAGE_LOG_PATH}\n")
+    print_summary(since)
+    if args.calls:
+        print()
+        print_calls(since, args.provider, args.model, args.calls)
+
+
+if __name__ == "__main__":
+    main()
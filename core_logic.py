@@ -8,123 +8,1489 @@ import os
 import re
 import time
 import traceback
+import threading
+import hashlib
+import sqlite3
+import random
+import email.utils
+from urllib.parse import urlsplit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pypdf import PdfReader, PdfWriter
 from pdf2image import convert_from_path
+from PIL import Image
+import numpy as np
 
-def convert_pdf_to_images(pdf_path, first_page, last_page):
+# Number of concurrent poppler renders (shared by all sessions)
+RENDER_WORKERS = int(os.environ.get("PDF_SPLITTER_RENDER_WORKERS", min(8, os.cpu_count() or 1)))
+
+# On-disk page render cache shared by all sessions
+CACHE_ROOT = os.environ.get("PDF_SPLITTER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pdf_splitter_cache"))
+RENDER_CACHE_DIR = os.path.join(CACHE_ROOT, "renders")
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("PDF_SPLITTER_RENDER_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# Files touched this recently are never evicted (they may still be in use)
+RENDER_CACHE_GRACE_SECONDS = 120
+
+# Number of threads encoding page images (PIL releases the GIL while encoding)
+ENCODE_WORKERS = int(os.environ.get("PDF_SPLITTER_ENCODE_WORKERS", os.cpu_count() or 1))
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+# Provider HTTP: pooled keep-alive sessions, timeouts and retry policy
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("PDF_SPLITTER_HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.environ.get("PDF_SPLITTER_HTTP_READ_TIMEOUT", 90))
+HTTP_MAX_RETRIES = int(os.environ.get("PDF_SPLITTER_HTTP_MAX_RETRIES", 3))
+HTTP_BACKOFF_BASE = float(os.environ.get("PDF_SPLITTER_HTTP_BACKOFF_BASE", 1.0))
+HTTP_BACKOFF_MAX = 30.0
+# Streaming responses: longest silence allowed between two received chunks once
+# the first one has arrived (the wait for it is bounded by HTTP_READ_TIMEOUT)
+HTTP_STREAM_READ_TIMEOUT = float(os.environ.get("PDF_SPLITTER_HTTP_STREAM_READ_TIMEOUT", 30))
+HTTP_RETRY_STATUSES = {408, 429, 500, 502, 503, 504, 529}
+
+# Failover chain: seconds to wait on a provider before hedging to the next one
+HEDGE_AFTER_SECONDS = float(os.environ.get("PDF_SPLITTER_HEDGE_AFTER_SECONDS", 20))
+
+# Batch jobs (OpenAI Batch / Anthropic Message Batches): status poll interval and give-up time
+BATCH_POLL_INTERVAL = float(os.environ.get("PDF_SPLITTER_BATCH_POLL_INTERVAL", 30))
+BATCH_TIMEOUT = float(os.environ.get("PDF_SPLITTER_BATCH_TIMEOUT", 24 * 3600))
+
+# Outputs cut off at the token limit: follow-up requests for the missing tail
+MAX_CONTINUATIONS = int(os.environ.get("PDF_SPLITTER_MAX_CONTINUATIONS", 2))
+
+# Schema-constrained output for providers that support it (0 = prompt-only JSON)
+STRUCTURED_OUTPUT = os.environ.get("PDF_SPLITTER_STRUCTURED_OUTPUT", "1") != "0"
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+_render_cache_lock = threading.Lock()
+_render_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# In-process LRU of encoded (base64) image payloads, shared by all providers
+ENCODE_CACHE_MAX_BYTES = int(os.environ.get("PDF_SPLITTER_ENCODE_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+
+_encode_cache = OrderedDict()  # key -> (b64_data, encode_seconds)
+_encode_cache_bytes = 0
+_encode_cache_lock = threading.Lock()
+_encode_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "saved_seconds": 0.0}
+
+# On-disk cache of successful provider responses, shared by all sessions
+VISION_CACHE_PATH = os.path.join(CACHE_ROOT, "vision_responses.sqlite3")
+VISION_CACHE_TTL_SECONDS = float(os.environ.get("PDF_SPLITTER_VISION_CACHE_TTL", 7 * 24 * 3600))
+VISION_CACHE_MAX_BYTES = int(os.environ.get("PDF_SPLITTER_VISION_CACHE_MAX_BYTES", 64 * 1024 ** 2))
+
+# Local log of every vision call (provider, model, payload, latency, tokens)
+USAGE_LOG_PATH = os.path.join(CACHE_ROOT, "vision_usage.sqlite3")
+USAGE_LOG_RETENTION_DAYS = float(os.environ.get("PDF_SPLITTER_USAGE_LOG_RETENTION_DAYS", 90))
+
+_usage_log_lock = threading.Lock()
+
+_vision_cache_lock = threading.Lock()
+_vision_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def _get_render_pool():
     """
-    Convert specific pages of a PDF to images using pdf2image.
+    Shared, bounded thread pool for poppler renders.
+    Threads are enough here: the heavy lifting happens in pdftoppm subprocesses.
+    A single pool caps total render concurrency across all sessions.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ThreadPoolExecutor(max_workers=max(1, RENDER_WORKERS), thread_name_prefix="pdf-render")
+        return _render_pool
+
+def budget_scale(width, height, budget):
     """
+    Largest scale factor that fits a width x height image into an image budget:
+    an int (longest edge in pixels) or a dict with any of long_side,
+    short_side and max_pixels. None when the budget sets no limit.
+    """
+    if isinstance(budget, int):
+        budget = {"long_side": budget}
+    scales = []
+    if budget.get("long_side"):
+        scales.append(budget["long_side"] / max(width, height))
+    if budget.get("short_side"):
+        scales.append(budget["short_side"] / min(width, height))
+    if budget.get("max_pixels"):
+        scales.append((budget["max_pixels"] / (width * height)) ** 0.5)
+    return min(scales) if scales else None
+
+def image_size_for_budget(width, height, budget, upscale=False):
+    """
+    (width, height) of an image scaled to fit the budget (see budget_scale).
+    Only downscales unless upscale is set (vector pages render at any size).
+    """
+    scale = budget_scale(width, height, budget) if budget else None
+    if scale is None or (scale >= 1 and not upscale):
+        return width, height
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def _page_render_sizes(pdf_path, first_page, last_page, budget):
+    """
+    Poppler target size (width, height) of each page in the range, from the
+    page's aspect ratio and the image budget. Stops at the end of the document.
+    """
+    reader = PdfReader(pdf_path, strict=False)
+    sizes = []
+    for page_number in range(first_page, min(last_page, len(reader.pages)) + 1):
+        page = reader.pages[page_number - 1]
+        width, height = float(page.cropbox.width), float(page.cropbox.height)
+        if page.rotation % 180:
+            width, height = height, width
+        sizes.append(image_size_for_budget(width, height, budget, upscale=True))
+    return sizes
+
+def _render_page_range_to_files(pdf_path, first_page, last_page, output_dir, fmt, dpi, size=None):
+    """
+    Render a contiguous page range to files with one poppler process.
+    size is poppler's target: longest edge (int) or exact (width, height).
+    Returns the file paths in page order.
+    """
+    return convert_from_path(
+        pdf_path,
+        dpi=dpi,
+        size=size,
+        first_page=first_page,
+        last_page=last_page,
+        fmt=fmt,
+        output_folder=output_dir,
+        output_file=f"page{first_page:05d}_",
+        paths_only=True
+    )
+
+def iter_pdf_page_files(pdf_path, first_page, last_page, output_dir, fmt="jpeg", dpi=200, workers=None, image_budget=None):
+    """
+    Render PDF pages straight to image files in output_dir.
+    Yields file paths in page order; poppler writes each page to disk itself
+    (paths_only), so no decoded page image is ever held in memory.
+
+    image_budget renders at a target resolution instead of a fixed DPI, so
+    page size no longer drives cost: an int is the longest edge in pixels, a
+    provider budget dict (see budget_scale) is turned into each page's exact
+    poppler size from its aspect ratio.
+
+    With workers > 1 the range is split into contiguous chunks rendered
+    concurrently on the shared render pool; pages are still yielded in order.
+    """
+    if workers is None:
+        workers = RENDER_WORKERS
+    page_count = last_page - first_page + 1
+    if page_count <= 0:
+        return
+
+    if isinstance(image_budget, dict):
+        try:
+            sizes = _page_render_sizes(pdf_path, first_page, last_page, image_budget)
+        except Exception as e:
+            print(f"Error reading page sizes of {pdf_path}: {e}")
+            return
+        page_count = len(sizes)
+        last_page = first_page + page_count - 1
+    else:
+        sizes = [image_budget] * page_count
+
+    if workers <= 1 or page_count == 1:
+        # Serial: one page per poppler call keeps peak memory at a single page
+        for page in range(first_page, last_page + 1):
+            try:
+                paths = _render_page_range_to_files(pdf_path, page, page, output_dir, fmt, dpi, sizes[page - first_page])
+            except Exception as e:
+                print(f"Error rendering page {page} to file: {e}")
+                return
+            if not paths:
+                # Past the end of the document
+                return
+            yield paths[0]
+        return
+
+    chunk_size = -(-page_count // workers)  # ceil division
+    pool = _get_render_pool()
+    futures = []
+    chunk_start = first_page
+    while chunk_start <= last_page:
+        # A chunk shares one poppler size, so it also ends where the page size changes
+        size = sizes[chunk_start - first_page]
+        chunk_end = chunk_start
+        while (chunk_end < min(chunk_start + chunk_size - 1, last_page)
+               and sizes[chunk_end + 1 - first_page] == size):
+            chunk_end += 1
+        futures.append((chunk_start, chunk_end, pool.submit(
+            _render_page_range_to_files, pdf_path, chunk_start, chunk_end, output_dir, fmt, dpi, size
+        )))
+        chunk_start = chunk_end + 1
+
     try:
-        # pdf2image uses 1-based indexing for first_page and last_page
-        images = convert_from_path(pdf_path, first_page=first_page, last_page=last_page)
-        return images
-    except Exception as e:
-        print(f"Error converting PDF to images: {e}")
-        return []
+        for chunk_start, chunk_end, future in futures:
+            try:
+                paths = future.result()
+            except Exception as e:
+                print(f"Error rendering pages {chunk_start}-{chunk_end} to files: {e}")
+                return
+            for path in paths:
+                yield path
+    finally:
+        for _, _, future in futures:
+            future.cancel()
 
-def encode_image(image):
+def file_sha256(path):
     """
-    Convert PIL Image to base64 string.
+    SHA-256 hex digest of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _render_cache_path(pdf_hash, page, fmt, dpi, image_budget):
+    """
+    Content-addressed cache location for one rendered page.
+    """
+    ext = "jpg" if fmt in ("jpeg", "jpg") else fmt
+    if isinstance(image_budget, dict):
+        resolution = "b" + "-".join(str(image_budget.get(k) or 0) for k in ("long_side", "short_side", "max_pixels"))
+    else:
+        resolution = f"s{image_budget}" if image_budget else f"d{dpi}"
+    return os.path.join(RENDER_CACHE_DIR, pdf_hash[:2], pdf_hash, f"p{page:05d}_{resolution}.{ext}")
+
+def iter_cached_page_files(pdf_path, first_page, last_page, fmt="jpeg", dpi=200, workers=None, image_budget=None, pdf_hash=None):
+    """
+    Same as iter_pdf_page_files, but backed by the on-disk render cache.
+    Pages are keyed by (PDF SHA-256, page, DPI/budget, format); cached pages are
+    yielded without rendering, and each contiguous run of misses is rendered
+    in one go and moved into the cache.
+    """
+    if pdf_hash is None:
+        pdf_hash = file_sha256(pdf_path)
+
+    page = first_page
+    while page <= last_page:
+        cached = _render_cache_path(pdf_hash, page, fmt, dpi, image_budget)
+        if os.path.exists(cached):
+            try:
+                # Bump mtime: eviction is least-recently-used first
+                os.utime(cached)
+            except OSError:
+                pass
+            with _render_cache_lock:
+                _render_cache_stats["hits"] += 1
+            yield cached
+            page += 1
+            continue
+
+        # Collect the run of consecutive misses starting here
+        run_end = page
+        while run_end < last_page and not os.path.exists(_render_cache_path(pdf_hash, run_end + 1, fmt, dpi, image_budget)):
+            run_end += 1
+
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        rendered_pages = 0
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(cached)) as staging_dir:
+            for offset, rendered in enumerate(iter_pdf_page_files(pdf_path, page, run_end, staging_dir, fmt=fmt, dpi=dpi, workers=workers, image_budget=image_budget)):
+                target = _render_cache_path(pdf_hash, page + offset, fmt, dpi, image_budget)
+                os.replace(rendered, target)
+                rendered_pages += 1
+                with _render_cache_lock:
+                    _render_cache_stats["misses"] += 1
+                yield target
+
+        if rendered_pages < run_end - page + 1:
+            # Rendering failed or ran past the end of the document
+            break
+        page = run_end + 1
+        evict_render_cache()
+
+def estimate_vision_payload(pdf_hash, first_page, last_page, fmt="jpeg", dpi=200, image_budget=None):
+    """
+    Estimate the base64 image payload a vision request for these pages would
+    carry, from the render cache alone (no rendering, no API call).
+    Returns None unless every page is already cached at this budget.
+    """
+    total = 0
+    for page in range(first_page, last_page + 1):
+        try:
+            size = os.path.getsize(_render_cache_path(pdf_hash, page, fmt, dpi, image_budget))
+        except OSError:
+            return None
+        total += (size + 2) // 3 * 4
+    return total
+
+def evict_render_cache(max_bytes=None):
+    """
+    Delete least-recently-used cached pages until the cache fits in max_bytes.
+    """
+    if max_bytes is None:
+        max_bytes = RENDER_CACHE_MAX_BYTES
+    entries = []
+    total = 0
+    for root, _, files in os.walk(RENDER_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+    if total <= max_bytes:
+        return 0
+
+    removed = 0
+    cutoff = time.time() - RENDER_CACHE_GRACE_SECONDS
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes or mtime > cutoff:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except OSError:
+            continue
+
+    with _render_cache_lock:
+        _render_cache_stats["evictions"] += removed
+    return removed
+
+def get_render_cache_stats():
+    """
+    Hit/miss/eviction counters of the render cache (since process start).
     """
+    with _render_cache_lock:
+        stats = dict(_render_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+# Image encoding profiles for provider payloads.
+# None (or "original") keeps the historical behaviour: JPEG at PIL's default
+# quality, pre-rendered JPEG files passed through untouched.
+ENCODING_PROFILES = {
+    "original": None,
+    "jpeg_color": {"label": "彩色 JPEG (质量 85)", "format": "JPEG", "quality": 85, "mode": "color", "max_side": None},
+    "jpeg_gray": {"label": "灰度 JPEG (质量 60，适合黑白扫描)", "format": "JPEG", "quality": 60, "mode": "grayscale", "max_side": None},
+    "png_bilevel": {"label": "黑白二值 PNG (最小体积)", "format": "PNG", "quality": None, "mode": "bilevel", "max_side": None},
+    "webp_gray": {"label": "灰度 WebP (质量 60)", "format": "WEBP", "quality": 60, "mode": "grayscale", "max_side": None},
+}
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+def _resolve_encoding_profile(profile):
+    if isinstance(profile, str):
+        return ENCODING_PROFILES.get(profile)
+    return profile
+
+def image_mime_type(profile=None):
+    """
+    MIME type of images produced by encode_image with this profile.
+    """
+    profile = _resolve_encoding_profile(profile)
+    if profile is None:
+        return "image/jpeg"
+    return _MIME_TYPES[profile["format"]]
+
+def _otsu_threshold(gray):
+    """
+    Otsu's threshold of a uint8 grayscale array (vectorized over the histogram).
+    """
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    sum_bg = np.cumsum(hist * levels)
+    mean_bg = sum_bg / np.maximum(weight_bg, 1)
+    mean_fg = (sum_bg[-1] - sum_bg) / np.maximum(weight_fg, 1)
+    between_var = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(between_var))
+
+def _estimate_skew(ink, max_angle=3.0, step=0.5):
+    """
+    Small-angle skew estimate: the rotation that makes text lines sharpest,
+    i.e. maximizes the variance of the row-wise ink profile.
+    Runs on a downsampled ink mask to keep it cheap.
+    """
+    mask = Image.fromarray((ink * 255).astype(np.uint8))
+    mask.thumbnail((800, 800))
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        rotated = np.asarray(mask.rotate(angle, resample=Image.NEAREST, expand=False))
+        score = float(np.var(rotated.sum(axis=1, dtype=np.float64)))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+def preprocess_scan(image, crop=True, deskew=True, binarize=True, noise_ratio=0.005, pad_ratio=0.02):
+    """
+    Clean up a scanned TOC page before upload: trim white/noisy margins to the
+    content bounding box, correct slight skew and binarize (Otsu).
+    Accepts a PIL image or an image file path; returns a grayscale PIL image.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        with Image.open(image) as src:
+            image = src.convert("L")
+    else:
+        image = image.convert("L")
+
+    gray = np.asarray(image)
+    threshold = _otsu_threshold(gray)
+    ink = gray < threshold
+
+    if deskew:
+        angle = _estimate_skew(ink)
+        if angle:
+            image = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+            gray = np.asarray(image)
+            ink = gray < threshold
+
+    if crop:
+        # Rows/columns with only scanner speckle don't count as content
+        rows = np.flatnonzero(ink.mean(axis=1) > noise_ratio)
+        cols = np.flatnonzero(ink.mean(axis=0) > noise_ratio)
+        if rows.size and cols.size:
+            pad = int(max(gray.shape) * pad_ratio)
+            top = max(0, rows[0] - pad)
+            bottom = min(gray.shape[0], rows[-1] + pad + 1)
+            left = max(0, cols[0] - pad)
+            right = min(gray.shape[1], cols[-1] + pad + 1)
+            gray = gray[top:bottom, left:right]
+            ink = ink[top:bottom, left:right]
+
+    if binarize:
+        return Image.fromarray(np.where(ink, 0, 255).astype(np.uint8))
+    return Image.fromarray(gray)
+
+def with_preprocessing(profile):
+    """
+    Copy of an encoding profile that runs preprocess_scan before encoding.
+    """
+    profile = _resolve_encoding_profile(profile)
+    if profile is None:
+        profile = {"label": "JPEG", "format": "JPEG", "quality": None, "mode": "grayscale", "max_side": None}
+    return dict(profile, preprocess=True)
+
+def _encode_with_profile(image, profile):
+    """
+    Apply an encoding profile (scan cleanup, mode, max dimension, format, quality) to a PIL image.
+    Returns the encoded bytes.
+    """
+    if profile.get("preprocess"):
+        image = preprocess_scan(image)
+
+    if profile.get("max_side") and max(image.size) > profile["max_side"]:
+        image = image.copy()
+        image.thumbnail((profile["max_side"], profile["max_side"]), Image.LANCZOS)
+
+    mode = profile.get("mode", "color")
+    if mode == "grayscale":
+        image = image.convert("L")
+    elif mode == "bilevel":
+        # Fixed threshold is enough for black-on-white scans
+        image = image.convert("L").point(lambda v: 255 if v > 160 else 0, mode="1")
+        if profile["format"] != "PNG":
+            image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    save_kwargs = {}
+    if profile.get("quality"):
+        save_kwargs["quality"] = profile["quality"]
+    if profile["format"] == "PNG":
+        save_kwargs["optimize"] = True
+
     buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    image.save(buffered, format=profile["format"], **save_kwargs)
+    return buffered.getvalue()
 
-def call_vision_api(provider, api_key, base_url, model, images, prompt):
+def encode_image(image, profile=None):
     """
-    Universal Vision API caller supporting multiple providers.
+    Convert PIL Image to base64 string.
+    A file path (e.g. from iter_pdf_page_files) is read as-is without re-encoding,
+    unless an encoding profile (name or dict from ENCODING_PROFILES) asks for
+    a different format, color mode or size.
+    Logs the payload bytes before and after encoding.
     """
-    provider_handlers = {
-        "Google Gemini": call_gemini_vision,
-        "OpenAI": call_openai_vision,
-        "Anthropic Claude": call_claude_vision,
-        "智谱 AI (Zhipu AI)": call_zhipu_vision,
-        "阿里通义千问 (Qwen)": call_qwen_vision,
-        "DeepSeek": call_openai_vision,  # DeepSeek uses OpenAI-compatible API
-    }
+    profile_name = profile if isinstance(profile, str) else "custom" if profile else "original"
+    profile = _resolve_encoding_profile(profile)
+
+    if isinstance(image, (str, os.PathLike)):
+        before = os.path.getsize(image)
+        if profile is None:
+            with open(image, 'rb') as f:
+                data = f.read()
+        else:
+            with Image.open(image) as src:
+                data = _encode_with_profile(src, profile)
+    else:
+        # Uncompressed pixel size of the in-memory image
+        before = image.size[0] * image.size[1] * len(image.getbands())
+        if profile is None:
+            buffered = io.BytesIO()
+            image.save(buffered, format="JPEG")
+            data = buffered.getvalue()
+        else:
+            data = _encode_with_profile(image, profile)
 
-    handler = provider_handlers.get(provider, call_openai_vision)
-    return handler(api_key, base_url, model, images, prompt)
+    b64_data = base64.b64encode(data).decode('utf-8')
+    print(f"Encoded image [{profile_name}]: {before} -> {len(data)} bytes ({len(b64_data)} base64)")
+    return b64_data
 
-def call_gemini_vision(api_key, base_url, model, images, prompt):
+def _image_content_hash(image):
+    """
+    SHA-256 of the image content: file bytes for paths, pixels for PIL images.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        return file_sha256(image)
+    digest = hashlib.sha256(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def encode_image_cached(image, profile=None):
+    """
+    encode_image memoized by (image content hash, encoding profile).
+    Retries and provider switches reuse the base64 payload instead of
+    re-encoding the same page.
     """
-    Call Gemini Vision API.
+    global _encode_cache_bytes
+    profile_key = json.dumps(_resolve_encoding_profile(profile), sort_keys=True)
+    key = (_image_content_hash(image), profile_key)
+
+    with _encode_cache_lock:
+        entry = _encode_cache.get(key)
+        if entry is not None:
+            _encode_cache.move_to_end(key)
+            _encode_cache_stats["hits"] += 1
+            _encode_cache_stats["saved_seconds"] += entry[1]
+            return entry[0]
+
+    start = time.perf_counter()
+    b64_data = encode_image(image, profile)
+    elapsed = time.perf_counter() - start
+
+    with _encode_cache_lock:
+        _encode_cache_stats["misses"] += 1
+        if key not in _encode_cache:
+            _encode_cache[key] = (b64_data, elapsed)
+            _encode_cache_bytes += len(b64_data)
+        while _encode_cache_bytes > ENCODE_CACHE_MAX_BYTES and len(_encode_cache) > 1:
+            _, (evicted, _) = _encode_cache.popitem(last=False)
+            _encode_cache_bytes -= len(evicted)
+            _encode_cache_stats["evictions"] += 1
+    return b64_data
+
+def get_encode_cache_stats():
+    """
+    Hit rate and CPU time saved by the encoded-payload cache (since process start).
+    """
+    with _encode_cache_lock:
+        stats = dict(_encode_cache_stats)
+        stats["entries"] = len(_encode_cache)
+        stats["bytes"] = _encode_cache_bytes
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+def _get_encode_pool():
+    """
+    Shared, bounded thread pool for image encoding.
+    """
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            _encode_pool = ThreadPoolExecutor(max_workers=max(1, ENCODE_WORKERS), thread_name_prefix="img-encode")
+        return _encode_pool
+
+def encode_images_parallel(images, profile=None):
+    """
+    Encode images on the shared encode pool, returning base64 strings in input order.
+    Each image is submitted as soon as the (possibly lazy) images iterable
+    yields it, so encoding overlaps with page rendering.
+    """
+    pool = _get_encode_pool()
+    futures = [pool.submit(encode_image_cached, img, profile) for img in images]
+    return [future.result() for future in futures]
+
+_IMAGE_PLACEHOLDER_RE = re.compile(r'@@PDF_SPLITTER_IMAGE_(\d+)@@')
+
+def image_placeholder(index):
+    """
+    Stand-in for the index-th encoded image inside a request payload.
+    StreamingJSONBody splices the real base64 data in at send time.
+    """
+    return f"@@PDF_SPLITTER_IMAGE_{index}@@"
+
+class StreamingJSONBody:
+    """
+    Low-copy JSON request body for requests.post(data=...).
+
+    The payload is serialized with image placeholders, so the JSON framing is
+    tiny; the pre-encoded base64 images are streamed between framing chunks
+    instead of being copied into one large string and then into bytes.
+    __len__ lets requests send Content-Length rather than chunked encoding,
+    and the body can be iterated again if a request is retried.
+    """
+
+    def __init__(self, payload, encoded_images):
+        framing = json.dumps(payload, ensure_ascii=False)
+        self._chunks = []
+        pos = 0
+        for match in _IMAGE_PLACEHOLDER_RE.finditer(framing):
+            self._chunks.append(framing[pos:match.start()].encode('utf-8'))
+            self._chunks.append(int(match.group(1)))
+            pos = match.end()
+        self._chunks.append(framing[pos:].encode('utf-8'))
+        self._images = encoded_images
+        self._length = sum(len(c) if isinstance(c, bytes) else len(self._images[c]) for c in self._chunks)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                yield chunk
+            else:
+                # base64 is pure ASCII: one image-sized bytes copy at a time
+                yield self._images[chunk].encode('ascii')
+
+def fit_image_to_budget(image, image_budget):
+    """
+    Downscale an image to fit an image budget (see budget_scale), by the same
+    rule the renderer uses to size pages.
+    Images already within budget (including pre-rendered files) are returned untouched.
+    """
+    if not image_budget:
+        return image
+    if isinstance(image, (str, os.PathLike)):
+        # Image.open only reads the header, so in-budget files cost nothing
+        with Image.open(image) as probe:
+            size = image_size_for_budget(*probe.size, image_budget)
+            if size == probe.size:
+                return image
+            image = probe.convert("RGB")
+    else:
+        size = image_size_for_budget(*image.size, image_budget)
+        if size == image.size:
+            return image
+    return image.resize(size, Image.LANCZOS)
+
+def get_http_session(url):
+    """
+    Shared keep-alive session for the scheme://host of url.
+    One session per provider host is shared by all threads; its urllib3
+    connection pool is thread-safe, so TCP+TLS handshakes are reused across
+    calls and sessions.
+    """
+    parts = urlsplit(url)
+    key = f"{parts.scheme}://{parts.netloc}"
+    with _http_sessions_lock:
+        session = _http_sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=32)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_sessions[key] = session
+        return session
+
+def _retry_after_seconds(response):
+    """
+    Parse a Retry-After header (delta-seconds or HTTP date); None if absent.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _backoff_delay(attempt):
     """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+def http_post(url, headers, data, **kwargs):
+    """
+    POST through the pooled session for url's host (see http_request).
+    """
+    return http_request("POST", url, headers, data, **kwargs)
+
+def http_get(url, headers, **kwargs):
+    """
+    GET through the pooled session for url's host (see http_request).
+    """
+    return http_request("GET", url, headers, **kwargs)
+
+def http_request(method, url, headers, data=None, connect_timeout=None, read_timeout=None, max_retries=None, stream=False, files=None, slot=None, timing=None):
+    """
+    Send a request through the pooled session for url's host.
+    With stream=True the body is left unread and read_timeout bounds the
+    wait for each chunk rather than the whole response.
+    Connection failures and 408/429/5xx responses are retried with exponential
+    backoff and jitter, honoring Retry-After. Read timeouts are not retried,
+    since the provider may already have done (and billed) the work.
+    data must be re-iterable (bytes, dict or StreamingJSONBody) so it can be
+    resent; files is passed through for multipart uploads.
+    slot is a concurrency slot (semaphore) the caller holds; it is handed
+    back while waiting out a backoff so other requests can use it.
+    A timing dict gets 'attempt_start' (perf_counter of the last attempt) and
+    'retry_seconds' (time spent on failed attempts and backoff before it).
+    """
+    if connect_timeout is None:
+        connect_timeout = HTTP_CONNECT_TIMEOUT
+    if read_timeout is None:
+        read_timeout = HTTP_READ_TIMEOUT
+    if max_retries is None:
+        max_retries = HTTP_MAX_RETRIES
+
+    session = get_http_session(url)
+    first_start = time.perf_counter()
+    for attempt in range(max_retries + 1):
+        if timing is not None:
+            timing["attempt_start"] = time.perf_counter()
+            timing["retry_seconds"] = timing["attempt_start"] - first_start
+        try:
+            response = session.request(method, url, headers=headers, data=data, files=files, timeout=(connect_timeout, read_timeout), stream=stream)
+        except requests.exceptions.ConnectionError as e:
+            if attempt >= max_retries:
+                raise
+            delay = _backoff_delay(attempt)
+            print(f"Connection error ({e}); retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+        else:
+            if response.status_code not in HTTP_RETRY_STATUSES or attempt >= max_retries:
+                return response
+            retry_after = _retry_after_seconds(response)
+            delay = min(HTTP_BACKOFF_MAX, retry_after) if retry_after is not None else _backoff_delay(attempt)
+            print(f"HTTP {response.status_code}; retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            response.close()
+        if slot is None:
+            time.sleep(delay)
+            continue
+        slot.release()
+        try:
+            time.sleep(delay)
+        finally:
+            slot.acquire()
+
+def _normalize_base_url(base_url):
     base_url = base_url.rstrip('/')
     if not base_url.startswith('http'):
         base_url = f"https://{base_url}"
+    return base_url
+
+# One TOC entry as the recognition prompt describes it
+CHAPTER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "page": {"type": "integer"},
+        "type": {"type": "string"},
+        "filename": {"type": "string"},
+    },
+    "required": ["title", "page", "type", "filename"],
+    "additionalProperties": False,
+}
+
+# OpenAI json_schema output and Claude tool inputs must be objects, so the
+# array is wrapped as {"chapters": [...]}
+CHAPTER_LIST_SCHEMA = {
+    "type": "object",
+    "properties": {"chapters": {"type": "array", "items": CHAPTER_SCHEMA}},
+    "required": ["chapters"],
+    "additionalProperties": False,
+}
 
-    # Construct URL for Google Native API
-    url = f"{base_url}/v1beta/models/{model}:generateContent?key={api_key}"
+# Gemini's responseSchema is an OpenAPI subset: upper-case types, no
+# additionalProperties, and a bare array is allowed
+GEMINI_CHAPTER_LIST_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "title": {"type": "STRING"},
+            "page": {"type": "INTEGER"},
+            "type": {"type": "STRING"},
+            "filename": {"type": "STRING"},
+        },
+        "required": ["title", "page", "type", "filename"],
+        "propertyOrdering": ["title", "page", "type", "filename"],
+    },
+}
 
-    print(f"Gemini Request URL: {url}")
+CLAUDE_CHAPTER_TOOL = "record_chapters"
 
+def prompt_parts(prompt):
+    """
+    (static prefix, per-document suffix) of a prompt.
+    A prompt is either a plain string (all static) or such a tuple; the
+    prefix goes first in every request so provider prompt caches can reuse it.
+    """
+    if isinstance(prompt, (tuple, list)):
+        return prompt[0], prompt[1]
+    return prompt, ""
+
+def prompt_text(prompt):
+    """
+    The full prompt text, prefix and suffix joined.
+    """
+    static, dynamic = prompt_parts(prompt)
+    return f"{static}\n\n{dynamic}" if dynamic else static
+
+def build_gemini_request(api_key, base_url, model, prompt, image_count, mime_type, structured_output=False):
+    """
+    Gemini native generateContent request.
+    Returns (url, headers, payload); images appear as image_placeholder(i).
+    The static prompt prefix leads the request for Gemini's implicit caching.
+    structured_output constrains the answer to GEMINI_CHAPTER_LIST_SCHEMA.
+    """
+    url = f"{_normalize_base_url(base_url)}/v1beta/models/{model}:generateContent?key={api_key}"
     headers = {"Content-Type": "application/json"}
 
-    parts = [{"text": prompt}]
-    for img in images:
-        b64_data = encode_image(img)
+    static, dynamic = prompt_parts(prompt)
+    parts = [{"text": static}]
+    if dynamic:
+        parts.append({"text": dynamic})
+    for i in range(image_count):
         parts.append({
             "inline_data": {
-                "mime_type": "image/jpeg",
-                "data": b64_data
+                "mime_type": mime_type,
+                "data": image_placeholder(i)
             }
         })
 
     payload = {"contents": [{"parts": parts}]}
+    if structured_output:
+        payload["generationConfig"] = {
+            "responseMimeType": "application/json",
+            "responseSchema": GEMINI_CHAPTER_LIST_SCHEMA,
+        }
+    return url, headers, payload
 
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=90)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        error_details = "No response"
-        if 'response' in locals() and hasattr(response, 'text'):
-            try:
-                error_details = response.text
-            except:
-                error_details = "Unable to read response"
-        return {"error": str(e), "details": error_details}
-
-def call_openai_vision(api_key, base_url, model, images, prompt):
+def build_openai_request(api_key, base_url, model, prompt, image_count, mime_type, structured_output=False):
     """
-    Call OpenAI-compatible Vision API (OpenAI, DeepSeek, etc.).
+    OpenAI-compatible chat/completions request (OpenAI, DeepSeek, Zhipu, Qwen, ...).
+    Returns (url, headers, payload); images appear as image_placeholder(i).
+    The static prompt prefix leads the request for automatic prefix caching.
+    structured_output asks for a strict json_schema answer ({"chapters": [...]}).
     """
-    base_url = base_url.rstrip('/')
-    if not base_url.startswith('http'):
-        base_url = f"https://{base_url}"
-
-    url = f"{base_url}/chat/completions"
-
-    print(f"OpenAI Request URL: {url}")
-
+    url = f"{_normalize_base_url(base_url)}/chat/completions"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}"
     }
 
-    # Build content with images
-    content = [{"type": "text", "text": prompt}]
-    for img in images:
-        b64_data = encode_image(img)
+    static, dynamic = prompt_parts(prompt)
+    content = [{"type": "text", "text": static}]
+    if dynamic:
+        content.append({"type": "text", "text": dynamic})
+    for i in range(image_count):
         content.append({
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{b64_data}"
+                "url": f"data:{mime_type};base64,{image_placeholder(i)}"
+            }
+        })
+
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": 8192
+    }
+    if structured_output:
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "toc_chapters", "strict": True, "schema": CHAPTER_LIST_SCHEMA},
+        }
+    return url, headers, payload
+
+def build_claude_request(api_key, base_url, model, prompt, image_count, mime_type, structured_output=False):
+    """
+    Anthropic Messages API request.
+    Returns (url, headers, payload); images appear as image_placeholder(i).
+    The static prompt prefix carries a cache_control breakpoint, so repeat
+    calls read it from Claude's prompt cache (prompts below the model's
+    minimum cacheable length are simply not cached).
+    structured_output forces a call of the CLAUDE_CHAPTER_TOOL tool, whose
+    input follows CHAPTER_LIST_SCHEMA.
+    """
+    url = f"{_normalize_base_url(base_url)}/v1/messages"
+    headers = {
+        "Content-Type": "application/json",
+        "x-api-key": api_key,
+        "anthropic-version": "2023-06-01"
+    }
+
+    static, dynamic = prompt_parts(prompt)
+    content = [{"type": "text", "text": static, "cache_control": {"type": "ephemeral"}}]
+    if dynamic:
+        content.append({"type": "text", "text": dynamic})
+    for i in range(image_count):
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": mime_type,
+                "data": image_placeholder(i)
             }
         })
 
-    payload = {
-        "model": model,
-        "messages": [{"role": "user", "content": content}],
-        "max_tokens": 8192
-    }
+    payload = {
+        "model": model,
+        "max_tokens": 8192,
+        "messages": [{"role": "user", "content": content}]
+    }
+    if structured_output:
+        payload["tools"] = [{
+            "name": CLAUDE_CHAPTER_TOOL,
+            "description": "Record the chapters recognized from the table of contents.",
+            "input_schema": CHAPTER_LIST_SCHEMA,
+        }]
+        payload["tool_choice"] = {"type": "tool", "name": CLAUDE_CHAPTER_TOOL}
+    return url, headers, payload
+
+# Streaming (SSE) variants of the three request protocols: switch a built
+# request to streaming, extract the text delta from one event, and wrap the
+# accumulated text as a regular response for the existing parsers.
+# The *_usage helpers read token counts (total input, output and prompt-cache
+# reads) from a response or stream event; *_truncated tells whether the
+# output was cut off at the token limit.
+
+def openai_stream_request(url, payload):
+    payload["stream"] = True
+    return url, payload
+
+def openai_stream_request_with_usage(url, payload):
+    # Ask for a final chunk carrying token usage (OpenAI, Qwen and DeepSeek accept stream_options)
+    url, payload = openai_stream_request(url, payload)
+    payload["stream_options"] = {"include_usage": True}
+    return url, payload
+
+def openai_stream_delta(event):
+    choices = event.get('choices') or []
+    if not choices:
+        return ''
+    return (choices[0].get('delta') or {}).get('content') or ''
+
+def openai_text_response(text, usage=None, truncated=False):
+    response_json = {"choices": [{"message": {"role": "assistant", "content": text},
+                                  "finish_reason": "length" if truncated else "stop"}]}
+    if usage:
+        response_json["usage"] = {
+            "prompt_tokens": usage.get("input_tokens"),
+            "completion_tokens": usage.get("output_tokens"),
+            "prompt_tokens_details": {"cached_tokens": usage.get("cached_input_tokens")},
+        }
+    return response_json
+
+def openai_usage(response_json):
+    usage = response_json.get('usage') or {}
+    # OpenAI and Qwen report prompt_tokens_details.cached_tokens, DeepSeek prompt_cache_hit_tokens
+    cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+    if cached is None:
+        cached = usage.get('prompt_cache_hit_tokens')
+    return {"input_tokens": usage.get('prompt_tokens'), "output_tokens": usage.get('completion_tokens'), "cached_input_tokens": cached}
+
+def openai_truncated(response_json):
+    choices = response_json.get('choices') or []
+    return bool(choices) and choices[0].get('finish_reason') == 'length'
+
+def gemini_stream_request(url, payload):
+    url = url.replace(":generateContent?", ":streamGenerateContent?alt=sse&", 1)
+    return url, payload
+
+def gemini_stream_delta(event):
+    candidates = event.get('candidates') or []
+    if not candidates:
+        return ''
+    parts = (candidates[0].get('content') or {}).get('parts') or []
+    return "".join(part.get('text', '') for part in parts)
+
+def gemini_text_response(text, usage=None, truncated=False):
+    response_json = {"candidates": [{"content": {"parts": [{"text": text}]},
+                                     "finishReason": "MAX_TOKENS" if truncated else "STOP"}]}
+    if usage:
+        response_json["usageMetadata"] = {
+            "promptTokenCount": usage.get("input_tokens"),
+            "candidatesTokenCount": usage.get("output_tokens"),
+            "cachedContentTokenCount": usage.get("cached_input_tokens"),
+        }
+    return response_json
+
+def gemini_usage(response_json):
+    usage = response_json.get('usageMetadata') or {}
+    return {"input_tokens": usage.get('promptTokenCount'), "output_tokens": usage.get('candidatesTokenCount'),
+            "cached_input_tokens": usage.get('cachedContentTokenCount')}
+
+def gemini_truncated(response_json):
+    candidates = response_json.get('candidates') or []
+    return bool(candidates) and candidates[0].get('finishReason') == 'MAX_TOKENS'
+
+def claude_stream_request(url, payload):
+    payload["stream"] = True
+    return url, payload
+
+def claude_stream_delta(event):
+    if event.get('type') != 'content_block_delta':
+        return ''
+    # Text answers stream text_delta, tool-use answers input_json_delta
+    delta = event.get('delta') or {}
+    return delta.get('text') or delta.get('partial_json') or ''
+
+def claude_text_response(text, usage=None, truncated=False):
+    response_json = {"content": [{"type": "text", "text": text}],
+                     "stop_reason": "max_tokens" if truncated else "end_turn"}
+    if usage:
+        cached = usage.get("cached_input_tokens")
+        total = usage.get("input_tokens")
+        response_json["usage"] = {
+            "input_tokens": total - (cached or 0) if total is not None else None,
+            "cache_read_input_tokens": cached,
+            "output_tokens": usage.get("output_tokens"),
+        }
+    return response_json
+
+def claude_usage(response_json):
+    # Streams report input tokens in message_start and output tokens in message_delta.
+    # Claude's input_tokens excludes cache reads and writes; report the total like the others.
+    usage = response_json.get('usage') or (response_json.get('message') or {}).get('usage') or {}
+    input_tokens = usage.get('input_tokens')
+    if input_tokens is not None:
+        input_tokens += (usage.get('cache_read_input_tokens') or 0) + (usage.get('cache_creation_input_tokens') or 0)
+    return {"input_tokens": input_tokens, "output_tokens": usage.get('output_tokens'),
+            "cached_input_tokens": usage.get('cache_read_input_tokens')}
+
+def claude_truncated(response_json):
+    # Streams carry the stop reason in the message_delta event
+    stop_reason = response_json.get('stop_reason') or (response_json.get('delta') or {}).get('stop_reason')
+    return stop_reason == 'max_tokens'
+
+def _iter_sse_events(response):
+    """
+    JSON payloads of the 'data:' lines of a server-sent event stream.
+    Lines are yielded as soon as they arrive (no fixed-size read buffer).
+    """
+    for line in response.iter_lines(chunk_size=None):
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            # Keep reading to the end so the connection can go back to the pool
+            continue
+        try:
+            yield json.loads(data.decode('utf-8'))
+        except ValueError:
+            print(f"Skipping malformed stream event: {data[:200]!r}")
+
+def _set_stream_read_timeout(response, timeout):
+    """
+    Change the read timeout of a response that is already being streamed.
+    Left unchanged if the connection's socket can't be reached; urllib3 sets
+    the timeout again when the connection is reused.
+    """
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+def _read_vision_stream(adapter, response, on_chapter, timing=None):
+    """
+    Consume a streaming response, passing each chapter to on_chapter as soon
+    as its JSON object is complete. Returns the accumulated text wrapped as a
+    regular (non-streaming) response, or an error dict.
+    The first event may take as long as a normal response (HTTP_READ_TIMEOUT);
+    after it, gaps between chunks are limited to HTTP_STREAM_READ_TIMEOUT.
+    A stream cut off after some text arrived (read timeout, dropped
+    connection) returns that text as a truncated response, so its complete
+    chapters are kept and the rest can be requested as a continuation.
+    timing['first_event'] is set to the perf_counter of the first event.
+    """
+    parser = IncrementalJSONArrayParser()
+    text_parts = []
+    usage = {}
+    truncated = False
+    first_event = True
+    try:
+        for event in _iter_sse_events(response):
+            if first_event:
+                first_event = False
+                _set_stream_read_timeout(response, HTTP_STREAM_READ_TIMEOUT)
+                if timing is not None:
+                    timing["first_event"] = time.perf_counter()
+            if "error" in event:
+                return {"error": str(event["error"]), "details": json.dumps(event, ensure_ascii=False)}
+            usage.update({k: v for k, v in adapter["usage"](event).items() if v is not None})
+            truncated = truncated or adapter["truncated"](event)
+            delta = adapter["stream_delta"](event)
+            if not delta:
+                continue
+            text_parts.append(delta)
+            for chapter in parser.feed(delta):
+                on_chapter(chapter)
+    except requests.exceptions.RequestException as e:
+        if not text_parts:
+            raise
+        print(f"{adapter['label']} stream interrupted after {len(parser.items)} chapters ({e}); keeping the partial output")
+        truncated = True
+    return adapter["text_response"]("".join(text_parts), usage, truncated)
+
+def _structured_output(adapter):
+    return STRUCTURED_OUTPUT and adapter["structured_output"]
+
+def get_provider_adapter(provider):
+    """
+    Adapter for a provider name; unknown providers are treated as OpenAI-compatible.
+    """
+    return PROVIDER_ADAPTERS.get(provider, PROVIDER_ADAPTERS["OpenAI"])
+
+def _provider_semaphore(provider):
+    """
+    Process-wide slot limiter for one provider, shared by every session.
+    """
+    adapter = get_provider_adapter(provider)
+    with _provider_semaphores_lock:
+        semaphore = _provider_semaphores.get(adapter["name"])
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(max(1, adapter["max_concurrency"]))
+            _provider_semaphores[adapter["name"]] = semaphore
+        return semaphore
+
+def _open_vision_cache():
+    os.makedirs(os.path.dirname(VISION_CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(VISION_CACHE_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER, body TEXT)"
+    )
+    return conn
+
+def vision_cache_key(provider, base_url, model, prompt, encoded_images):
+    """
+    Cache key of one vision request: provider, endpoint, model, prompt hash
+    and the hashes of the encoded images actually sent (so the encoding
+    profile and image size budget are part of the key).
+    """
+    digest = hashlib.sha256()
+    for part in (get_provider_adapter(provider)["name"], base_url or "", model):
+        digest.update(part.encode('utf-8') + b"\0")
+    digest.update(hashlib.sha256(prompt_text(prompt).encode('utf-8')).digest())
+    for b64_data in encoded_images:
+        digest.update(hashlib.sha256(b64_data.encode('ascii')).digest())
+    return digest.hexdigest()
+
+def vision_cache_get(key):
+    """
+    Cached response for key, or None when missing or older than the TTL.
+    """
+    now = time.time()
+    try:
+        with _vision_cache_lock:
+            conn = _open_vision_cache()
+            try:
+                row = conn.execute("SELECT created, body FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[0] <= VISION_CACHE_TTL_SECONDS:
+                    with conn:
+                        conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                    _vision_cache_stats["hits"] += 1
+                    response_json = json.loads(row[1])
+                    response_json["from_cache"] = {"age_seconds": now - row[0]}
+                    return response_json
+            finally:
+                conn.close()
+            _vision_cache_stats["misses"] += 1
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"Vision cache read failed: {e}")
+    return None
+
+def vision_cache_put(key, response_json):
+    """
+    Store a successful response, then drop expired entries and evict least
+    recently used ones until the cache fits in VISION_CACHE_MAX_BYTES.
+    """
+    body = json.dumps(response_json, ensure_ascii=False)
+    now = time.time()
+    try:
+        with _vision_cache_lock:
+            conn = _open_vision_cache()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO responses (key, created, accessed, size, body) VALUES (?, ?, ?, ?, ?)",
+                        (key, now, now, len(body), body)
+                    )
+                    removed = conn.execute(
+                        "DELETE FROM responses WHERE created < ?", (now - VISION_CACHE_TTL_SECONDS,)
+                    ).rowcount
+                    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                    if total > VISION_CACHE_MAX_BYTES:
+                        for old_key, size in conn.execute(
+                            "SELECT key, size FROM responses WHERE key != ? ORDER BY accessed", (key,)
+                        ).fetchall():
+                            if total <= VISION_CACHE_MAX_BYTES:
+                                break
+                            conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                            total -= size
+                            removed += 1
+            finally:
+                conn.close()
+            _vision_cache_stats["evictions"] += removed
+    except (sqlite3.Error, OSError) as e:
+        print(f"Vision cache write failed: {e}")
+
+def get_vision_cache_stats():
+    """
+    Hit/miss/eviction counters of the vision response cache (since process start).
+    """
+    with _vision_cache_lock:
+        stats = dict(_vision_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+def _open_usage_log():
+    os.makedirs(os.path.dirname(USAGE_LOG_PATH), exist_ok=True)
+    conn = sqlite3.connect(USAGE_LOG_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS calls ("
+        "ts REAL, provider TEXT, model TEXT, images INTEGER, payload_bytes INTEGER, streamed INTEGER, "
+        "status TEXT, ttfb_seconds REAL, total_seconds REAL, input_tokens INTEGER, output_tokens INTEGER, "
+        "parsed_chapters INTEGER, error TEXT, cached_input_tokens INTEGER, retry_seconds REAL)"
+    )
+    # Logs written by older versions lack the later columns
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(calls)")}
+    for column, column_type in (("cached_input_tokens", "INTEGER"), ("retry_seconds", "REAL")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE calls ADD COLUMN {column} {column_type}")
+    conn.execute("CREATE INDEX IF NOT EXISTS calls_ts ON calls (ts)")
+    return conn
+
+_USAGE_LOG_COLUMNS = (
+    "ts", "provider", "model", "images", "payload_bytes", "streamed", "status", "ttfb_seconds",
+    "total_seconds", "input_tokens", "output_tokens", "parsed_chapters", "error", "cached_input_tokens",
+    "retry_seconds",
+)
+
+def _record_vision_call(record, call_start, response_json=None, status="ok", ttfb=None, error=None, timing=None, parsed_chapters=None):
+    """
+    Complete a call record (latency, tokens, parse result) and append it to
+    the usage log. parsed_chapters is the chapter count the caller already
+    parsed from the response; the response is not parsed again here.
+    Logging problems are printed and never fail the call.
+    Time spent on failed attempts and retry backoff (timing['retry_seconds'],
+    see http_request) is logged as retry_seconds and left out of total_seconds.
+    """
+    adapter = get_provider_adapter(record["provider"])
+    retry_seconds = (timing or {}).get("retry_seconds", 0.0)
+    record = dict(record, ts=time.time(), status=status, ttfb_seconds=ttfb, retry_seconds=retry_seconds,
+                  total_seconds=time.perf_counter() - call_start - retry_seconds, error=error)
+    if response_json is not None and status not in ("error", "cached"):
+        record.update(adapter["usage"](response_json))
+    record["parsed_chapters"] = parsed_chapters
+    try:
+        with _usage_log_lock:
+            conn = _open_usage_log()
+            try:
+                with conn:
+                    conn.execute(
+                        f"INSERT INTO calls ({', '.join(_USAGE_LOG_COLUMNS)}) VALUES ({', '.join('?' * len(_USAGE_LOG_COLUMNS))})",
+                        tuple(record.get(column) for column in _USAGE_LOG_COLUMNS)
+                    )
+                    conn.execute("DELETE FROM calls WHERE ts < ?", (time.time() - USAGE_LOG_RETENTION_DAYS * 86400,))
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError) as e:
+        print(f"Usage log write failed: {e}")
+
+def query_vision_calls(since=None, provider=None, model=None, limit=1000):
+    """
+    Logged vision calls, newest first, as dicts (see _USAGE_LOG_COLUMNS).
+    since is a Unix timestamp; provider and model filter exactly.
+    """
+    clauses, params = [], []
+    for column, value in (("ts >=", since), ("provider =", provider), ("model =", model)):
+        if value is not None:
+            clauses.append(f"{column} ?")
+            params.append(value)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    try:
+        with _usage_log_lock:
+            conn = _open_usage_log()
+            try:
+                rows = conn.execute(
+                    f"SELECT {', '.join(_USAGE_LOG_COLUMNS)} FROM calls {where} ORDER BY ts DESC LIMIT ?",
+                    params + [limit]
+                ).fetchall()
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError) as e:
+        print(f"Usage log read failed: {e}")
+        return []
+    return [dict(zip(_USAGE_LOG_COLUMNS, row)) for row in rows]
+
+def _percentile(values, q):
+    """
+    Nearest-rank percentile of a list of numbers (None when empty).
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(-(-q * len(ordered) // 100)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def summarize_vision_calls(since=None):
+    """
+    Per provider/model statistics of the usage log: call counts, success and
+    parse rates, latency percentiles of calls that reached the provider
+    (retry backoff excluded), mean retry time, mean payload and tokens, share
+    of input tokens read from the provider's prompt cache, and output tokens
+    per second.
+    """
+    groups = OrderedDict()
+    for row in query_vision_calls(since=since, limit=-1):
+        groups.setdefault((row["provider"], row["model"]), []).append(row)
+
+    summary = []
+    for (provider, model), rows in groups.items():
+        live = [r for r in rows if r["status"] == "ok"]
+        totals = [r["total_seconds"] for r in live]
+        ttfbs = [r["ttfb_seconds"] for r in live if r["ttfb_seconds"] is not None]
+        input_tokens = [r["input_tokens"] for r in live if r["input_tokens"] is not None]
+        output_tokens = [r["output_tokens"] for r in live if r["output_tokens"] is not None]
+        cache_reported = [r for r in live if r["cached_input_tokens"] is not None and r["input_tokens"]]
+        token_seconds = sum(r["total_seconds"] for r in live if r["output_tokens"] is not None)
+        retries = [r["retry_seconds"] for r in rows if r["status"] != "cached" and r["retry_seconds"] is not None]
+        summary.append({
+            "provider": provider,
+            "model": model,
+            "calls": len(rows),
+            "cached": sum(1 for r in rows if r["status"] == "cached"),
+            "errors": sum(1 for r in rows if r["status"] == "error"),
+            "parse_rate": sum(1 for r in live if r["parsed_chapters"]) / len(live) if live else None,
+            "p50_seconds": _percentile(totals, 50),
+            "p90_seconds": _percentile(totals, 90),
+            "p99_seconds": _percentile(totals, 99),
+            "p50_ttfb_seconds": _percentile(ttfbs, 50),
+            "p90_ttfb_seconds": _percentile(ttfbs, 90),
+            "mean_retry_seconds": sum(retries) / len(retries) if retries else None,
+            "mean_payload_bytes": sum(r["payload_bytes"] or 0 for r in live) / len(live) if live else None,
+            "mean_input_tokens": sum(input_tokens) / len(input_tokens) if input_tokens else None,
+            "mean_output_tokens": sum(output_tokens) / len(output_tokens) if output_tokens else None,
+            "prompt_cache_ratio": (sum(r["cached_input_tokens"] for r in cache_reported) /
+                                   sum(r["input_tokens"] for r in cache_reported)) if cache_reported else None,
+            "output_tokens_per_second": sum(output_tokens) / token_seconds if token_seconds else None,
+        })
+    return summary
+
+def call_vision_api(provider, api_key, base_url, model, images, prompt, image_budget=None, encoding_profile=None, use_cache=True, on_chapter=None):
+    """
+    Universal Vision API caller supporting multiple providers.
+    The provider adapter builds the request; the HTTP call waits for one of the
+    provider's concurrency slots so simultaneous sessions can't exceed its limit.
+    image_budget is the provider's image budget (see budget_scale); anything
+    larger would only be downsampled server-side, so it is shrunk here.
+    encoding_profile selects how images are encoded (see ENCODING_PROFILES).
+    Complete responses that parse to chapters are kept in the on-disk vision
+    cache; a cached response carries a 'from_cache' entry. use_cache=False forces a new call.
+    With on_chapter the response is streamed and on_chapter(chapter) is
+    called for each chapter as soon as it is complete; the return value is
+    the same as without streaming.
+    An output cut off at the token limit keeps its complete chapters and only
+    the missing tail is requested again (see MAX_CONTINUATIONS); the merged
+    chapters are returned as one regular response.
+    Every call is recorded in the usage log (see summarize_vision_calls).
+    """
+    call_start = time.perf_counter()
+    adapter = get_provider_adapter(provider)
+    if image_budget is None:
+        image_budget = adapter["image_budget"]
+    if image_budget:
+        images = (fit_image_to_budget(img, image_budget) for img in images)
+
+    # Encoding is local CPU work: do it before taking a provider slot
+    encoded_images = encode_images_parallel(images, encoding_profile)
+    record = {"provider": adapter["name"], "model": model, "images": len(encoded_images), "streamed": int(on_chapter is not None)}
+    cache_key = vision_cache_key(provider, base_url, model, prompt, encoded_images)
+    if use_cache:
+        cached = vision_cache_get(cache_key)
+        if cached is not None:
+            print(f"{adapter['label']} response served from cache ({cache_key[:12]})")
+            _record_vision_call(record, call_start, cached, status="cached", parsed_chapters=len(adapter["parse_response"](cached)))
+            return cached
+
+    structured_output = _structured_output(adapter)
+    response_json, chapters = _send_vision_request(
+        adapter, api_key, base_url, model, prompt, encoded_images, encoding_profile, on_chapter, record, call_start, structured_output
+    )
+    if structured_output and "error" not in response_json and adapter["truncated"](response_json) and not chapters:
+        # A tool call cut off at the token limit carries no usable input; a
+        # plain-text answer can at least be recovered and continued
+        print(f"{adapter['label']} structured output truncated with nothing usable; retrying as plain text")
+        structured_output = False
+        response_json, chapters = _send_vision_request(
+            adapter, api_key, base_url, model, prompt, encoded_images, encoding_profile, on_chapter, record, time.perf_counter(), structured_output
+        )
+    if "error" not in response_json and adapter["truncated"](response_json):
+        response_json, chapters = _continue_truncated_response(
+            adapter, api_key, base_url, model, prompt, encoded_images, encoding_profile, on_chapter, record, response_json, chapters, structured_output
+        )
+    # Only complete, parseable answers are worth replaying; anything else gets a fresh call next time
+    if "error" not in response_json and not adapter["truncated"](response_json) and chapters:
+        vision_cache_put(cache_key, response_json)
+    return response_json
+
+def _send_vision_request(adapter, api_key, base_url, model, prompt, encoded_images, encoding_profile, on_chapter, record, call_start, structured_output):
+    """
+    One provider call of call_vision_api, streamed when on_chapter is given.
+    Returns (response or error dict, parsed chapters); the response is parsed
+    once here and the call is recorded in the usage log.
+    """
+    url, headers, payload = adapter["build_request"](
+        api_key, base_url, model, prompt, len(encoded_images), image_mime_type(encoding_profile),
+        structured_output=structured_output
+    )
+
+    stream = on_chapter is not None
+    if stream:
+        url, payload = adapter["stream_request"](url, payload)
 
+    print(f"{adapter['label']} Request URL: {url}")
+
+    body = StreamingJSONBody(payload, encoded_images)
+    record = dict(record, payload_bytes=len(body))
+    timing = {}
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=90)
-        response.raise_for_status()
-        return response.json()
+        slot = _provider_semaphore(adapter["name"])
+        with slot:
+            if stream:
+                response = http_post(url, headers, body, stream=True, slot=slot, timing=timing)
+                response.raise_for_status()
+                with response:
+                    response_json = _read_vision_stream(adapter, response, on_chapter, timing)
+                ttfb = timing["first_event"] - timing["attempt_start"] if "first_event" in timing else None
+                if "error" in response_json:
+                    _record_vision_call(record, call_start, status="error", ttfb=ttfb, error=response_json["error"], timing=timing)
+                    return response_json, []
+            else:
+                # Body left unread until after the headers arrive, to time the first byte
+                response = http_post(url, headers, body, stream=True, slot=slot, timing=timing)
+                ttfb = time.perf_counter() - timing["attempt_start"]
+                response.raise_for_status()
+                response_json = response.json()
+        chapters = adapter["parse_response"](response_json)
+        _record_vision_call(record, call_start, response_json, ttfb=ttfb, timing=timing, parsed_chapters=len(chapters))
+        return response_json, chapters
     except requests.exceptions.RequestException as e:
         error_details = "No response"
         if 'response' in locals() and hasattr(response, 'text'):
@@ -132,153 +1498,491 @@ def call_openai_vision(api_key, base_url, model, images, prompt):
                 error_details = response.text
             except:
                 error_details = "Unable to read response"
-        return {"error": str(e), "details": error_details}
+        _record_vision_call(record, call_start, status="error", error=str(e), timing=timing)
+        return {"error": str(e), "details": error_details}, []
+
+def _chapter_key(chapter):
+    return ("".join(str(chapter.get('title', '')).split()), str(chapter.get('page', '')))
 
-def call_claude_vision(api_key, base_url, model, images, prompt):
+def build_continuation_prompt(prompt, chapters):
     """
-    Call Anthropic Claude Vision API.
+    Prompt asking for the entries after the last one already received, for an
+    output cut off at the token limit. The static prefix is kept as is.
     """
-    base_url = base_url.rstrip('/')
-    if not base_url.startswith('http'):
-        base_url = f"https://{base_url}"
+    static, dynamic = prompt_parts(prompt)
+    note = (
+        "# 续写说明\n"
+        f"上一次输出因长度限制被截断，已收到 {len(chapters)} 个条目，最后一个是：\n"
+        f"{json.dumps(chapters[-1], ensure_ascii=False)}\n"
+        "请从这个条目之后继续，只输出剩余条目组成的 JSON 数组（格式与上文相同），不要重复已输出的条目。"
+    )
+    return (static, f"{dynamic}\n\n{note}" if dynamic else note)
 
-    url = f"{base_url}/v1/messages"
+def _continue_truncated_response(adapter, api_key, base_url, model, prompt, encoded_images, encoding_profile, on_chapter, record, response_json, chapters, structured_output):
+    """
+    Complete a response cut off at the token limit: keep the chapters already
+    recovered and request only the missing tail, up to MAX_CONTINUATIONS
+    times. Tail requests use the same structured_output as the response they
+    continue, so a plain-text fallback stays plain text. chapters are the
+    ones already parsed from response_json. Returns (merged chapters wrapped
+    as a regular response, merged chapters).
+    """
+    usage = adapter["usage"](response_json)
+    truncated = True
+    continuations = 0
+    while truncated and chapters and continuations < MAX_CONTINUATIONS:
+        continuations += 1
+        print(f"{adapter['label']} output truncated after {len(chapters)} chapters; requesting the rest ({continuations}/{MAX_CONTINUATIONS})")
+        seen = {_chapter_key(chapter) for chapter in chapters if isinstance(chapter, dict)}
 
-    print(f"Claude Request URL: {url}")
+        def on_new_chapter(chapter):
+            # The model may repeat the last entries it was shown; only pass on new ones
+            if isinstance(chapter, dict) and _chapter_key(chapter) not in seen:
+                seen.add(_chapter_key(chapter))
+                on_chapter(chapter)
 
-    headers = {
-        "Content-Type": "application/json",
-        "x-api-key": api_key,
-        "anthropic-version": "2023-06-01"
-    }
+        tail_json, tail = _send_vision_request(
+            adapter, api_key, base_url, model, build_continuation_prompt(prompt, chapters), encoded_images,
+            encoding_profile, on_new_chapter if on_chapter else None, record, time.perf_counter(),
+            structured_output
+        )
+        if "error" in tail_json:
+            print(f"{adapter['label']} continuation failed: {tail_json['error']}")
+            break
+        for key, value in adapter["usage"](tail_json).items():
+            if value is not None:
+                usage[key] = (usage.get(key) or 0) + value
+        truncated = adapter["truncated"](tail_json)
+        merged = merge_chapter_lists([chapters, tail])
+        if len(merged) == len(chapters):
+            # Nothing new came back; asking again would not help
+            break
+        chapters = merged
+    if not continuations:
+        return response_json, chapters
+    return adapter["text_response"](json.dumps(chapters, ensure_ascii=False), usage, truncated), chapters
 
-    # Build content with images
-    content = [{"type": "text", "text": prompt}]
-    for img in images:
-        b64_data = encode_image(img)
-        content.append({
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": "image/jpeg",
-                "data": b64_data
-            }
-        })
+# Per-job input limits of the batch APIs, in decimal megabytes so the
+# framing added around the input file stays within the documented size
+OPENAI_BATCH_MAX_BYTES = 200 * 1000 * 1000
+OPENAI_BATCH_MAX_REQUESTS = 50_000
+ANTHROPIC_BATCH_MAX_BYTES = 256 * 1000 * 1000
+ANTHROPIC_BATCH_MAX_REQUESTS = 100_000
 
-    payload = {
-        "model": model,
-        "max_tokens": 8192,
-        "messages": [{"role": "user", "content": content}]
-    }
+def _iter_batch_bodies(adapter, api_key, base_url, model, items, image_budget, encoding_profile):
+    """
+    Serialized request bodies of batch items as (custom_id, body bytes).
+    Images are encoded one item at a time and spliced straight into bytes,
+    so only the current item is held in memory.
+    """
+    for item in items:
+        images = item["images"]
+        if image_budget:
+            images = (fit_image_to_budget(img, image_budget) for img in images)
+        encoded_images = encode_images_parallel(images, encoding_profile)
+        _, _, payload = adapter["build_request"](
+            api_key, base_url, model, item["prompt"], len(encoded_images), image_mime_type(encoding_profile),
+            structured_output=_structured_output(adapter)
+        )
+        yield item["custom_id"], b"".join(StreamingJSONBody(payload, encoded_images))
 
+def _write_batch_files(bodies, out_dir, serialize, max_bytes, max_requests, separator=b""):
+    """
+    Write (custom_id, body) pairs through serialize(custom_id, body) into as
+    many input files under out_dir as it takes to keep each one within
+    max_bytes and max_requests; separator goes between requests in a file.
+    Yields (path, custom_ids) as soon as each file is complete. A single
+    request larger than max_bytes still gets a file of its own.
+    """
+    index = 0
+    f = None
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=90)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        error_details = "No response"
-        if 'response' in locals() and hasattr(response, 'text'):
-            try:
-                error_details = response.text
-            except:
-                error_details = "Unable to read response"
-        return {"error": str(e), "details": error_details}
+        for custom_id, body in bodies:
+            request = serialize(custom_id, body)
+            if f is not None and (len(custom_ids) >= max_requests
+                                  or size + len(separator) + len(request) > max_bytes):
+                f.close()
+                f = None
+                yield path, custom_ids
+            if f is None:
+                index += 1
+                path = os.path.join(out_dir, f"batch_{index:04d}.jsonl")
+                f = open(path, 'wb')
+                custom_ids = []
+                size = 0
+            elif separator:
+                f.write(separator)
+                size += len(separator)
+            f.write(request)
+            size += len(request)
+            custom_ids.append(custom_id)
+        if f is not None:
+            f.close()
+            f = None
+            yield path, custom_ids
+    finally:
+        if f is not None:
+            f.close()
 
-def call_zhipu_vision(api_key, base_url, model, images, prompt):
+class StreamingFileBody:
     """
-    Call Zhipu AI Vision API (GLM-4V).
-    Uses OpenAI-compatible format.
+    Request body streamed from a file on disk between optional leading and
+    trailing bytes (e.g. multipart framing), for requests.post(data=...).
+    Like StreamingJSONBody it has a length and can be iterated again if a
+    request is retried.
     """
-    base_url = base_url.rstrip('/')
-    if not base_url.startswith('http'):
-        base_url = f"https://{base_url}"
 
-    url = f"{base_url}/chat/completions"
+    def __init__(self, path, prefix=b"", suffix=b"", chunk_size=1024 * 1024):
+        self._path = path
+        self._prefix = prefix
+        self._suffix = suffix
+        self._chunk_size = chunk_size
 
-    print(f"Zhipu Request URL: {url}")
+    def __len__(self):
+        return len(self._prefix) + os.path.getsize(self._path) + len(self._suffix)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+    def __iter__(self):
+        yield self._prefix
+        with open(self._path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self._chunk_size), b''):
+                yield chunk
+        yield self._suffix
 
-    # Build content with images
-    content = [{"type": "text", "text": prompt}]
-    for img in images:
-        b64_data = encode_image(img)
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{b64_data}"
-            }
-        })
+def _wait_for_batch(poll, is_done, poll_interval, timeout):
+    """
+    Call poll() every poll_interval seconds until is_done(status) or timeout.
+    Returns the last status.
+    """
+    deadline = time.time() + timeout
+    while True:
+        status = poll()
+        if is_done(status) or time.time() >= deadline:
+            return status
+        time.sleep(poll_interval)
 
-    payload = {
-        "model": model,
-        "messages": [{"role": "user", "content": content}],
-        "max_tokens": 8192
-    }
+def _wait_for_batches(jobs, poll_one, is_done, poll_interval, timeout):
+    """
+    Poll every batch id in jobs with poll_one(batch_id) until all of them
+    are done or timeout; finished jobs are not polled again.
+    Returns {batch_id: last status}.
+    """
+    statuses = {}
 
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=90)
+    def poll():
+        for batch_id in jobs:
+            if batch_id not in statuses or not is_done(statuses[batch_id]):
+                statuses[batch_id] = poll_one(batch_id)
+        return statuses
+
+    return _wait_for_batch(poll, lambda s: all(is_done(status) for status in s.values()), poll_interval, timeout)
+
+def run_openai_batch(api_key, base_url, headers, bodies, out_dir, poll_interval, timeout):
+    """
+    OpenAI Batch API: write the requests as JSONL input files under out_dir,
+    split to stay within OPENAI_BATCH_MAX_BYTES / OPENAI_BATCH_MAX_REQUESTS,
+    upload each from disk and create a batch on /v1/chat/completions for it.
+    Then poll all the batches and read their output and error files.
+    Returns {custom_id: response body or error dict}.
+    """
+    base = _normalize_base_url(base_url)
+    auth = {"Authorization": headers["Authorization"]}
+    boundary = os.urandom(16).hex()
+    multipart_head = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="batch.jsonl"\r\n'
+        'Content-Type: application/jsonl\r\n\r\n'
+    ).encode('utf-8')
+    multipart_tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+    def serialize(custom_id, body):
+        return (b'{"custom_id": ' + json.dumps(custom_id).encode('utf-8')
+                + b', "method": "POST", "url": "/v1/chat/completions", "body": ' + body + b'}\n')
+
+    jobs = OrderedDict()
+    results = {}
+    max_bytes = OPENAI_BATCH_MAX_BYTES - len(multipart_head) - len(multipart_tail)
+    for path, custom_ids in _write_batch_files(bodies, out_dir, serialize, max_bytes, OPENAI_BATCH_MAX_REQUESTS):
+        try:
+            upload = http_post(
+                f"{base}/files", dict(auth, **{"Content-Type": f"multipart/form-data; boundary={boundary}"}),
+                StreamingFileBody(path, multipart_head, multipart_tail)
+            )
+            upload.raise_for_status()
+            batch = http_post(
+                f"{base}/batches", dict(auth, **{"Content-Type": "application/json"}),
+                json.dumps({"input_file_id": upload.json()["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"})
+            )
+            batch.raise_for_status()
+            batch_id = batch.json()["id"]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            # One rejected job doesn't sink the ones already submitted
+            print(f"OpenAI batch submission failed for {len(custom_ids)} requests: {e}")
+            results.update({custom_id: {"error": str(e)} for custom_id in custom_ids})
+            continue
+        finally:
+            os.remove(path)
+        jobs[batch_id] = custom_ids
+        print(f"OpenAI batch {batch_id}: {len(custom_ids)} requests submitted")
+
+    def poll(batch_id):
+        response = http_get(f"{base}/batches/{batch_id}", auth)
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        error_details = "No response"
-        if 'response' in locals() and hasattr(response, 'text'):
-            try:
-                error_details = response.text
-            except:
-                error_details = "Unable to read response"
-        return {"error": str(e), "details": error_details}
+        status = response.json()
+        print(f"OpenAI batch {batch_id}: {status.get('status')} {status.get('request_counts', {})}")
+        return status
+
+    statuses = _wait_for_batches(jobs, poll, lambda s: s.get("status") in ("completed", "failed", "expired", "cancelled"), poll_interval, timeout)
+    for batch_id, custom_ids in jobs.items():
+        status = statuses[batch_id]
+        for file_key in ("output_file_id", "error_file_id"):
+            if not status.get(file_key):
+                continue
+            content = http_get(f"{base}/files/{status[file_key]}/content", auth)
+            content.raise_for_status()
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    results[record["custom_id"]] = {"error": str(record.get("error") or response.get("body")), "details": line}
+                else:
+                    results[record["custom_id"]] = response["body"]
+        for custom_id in custom_ids:
+            results.setdefault(custom_id, {"error": f"batch {batch_id} {status.get('status')} without a result for this request"})
+    return results
 
-def call_qwen_vision(api_key, base_url, model, images, prompt):
+def run_anthropic_batch(api_key, base_url, headers, bodies, out_dir, poll_interval, timeout):
     """
-    Call Qwen Vision API (Alibaba DashScope).
-    Uses OpenAI-compatible format.
+    Anthropic Message Batches API: write the messages requests to files under
+    out_dir, split to stay within ANTHROPIC_BATCH_MAX_BYTES /
+    ANTHROPIC_BATCH_MAX_REQUESTS, and create a batch from each file.
+    Then poll until every batch has ended and read their JSONL results.
+    Returns {custom_id: message or error dict}.
     """
-    base_url = base_url.rstrip('/')
-    if not base_url.startswith('http'):
-        base_url = f"https://{base_url}"
+    base = _normalize_base_url(base_url)
+    request_head = b'{"requests": ['
+    request_tail = b']}'
 
-    url = f"{base_url}/chat/completions"
+    def serialize(custom_id, body):
+        return b'{"custom_id": ' + json.dumps(custom_id).encode('utf-8') + b', "params": ' + body + b'}'
 
-    print(f"Qwen Request URL: {url}")
+    jobs = OrderedDict()
+    results = {}
+    max_bytes = ANTHROPIC_BATCH_MAX_BYTES - len(request_head) - len(request_tail)
+    for path, custom_ids in _write_batch_files(bodies, out_dir, serialize, max_bytes, ANTHROPIC_BATCH_MAX_REQUESTS, separator=b", "):
+        try:
+            batch = http_post(f"{base}/v1/messages/batches", headers, StreamingFileBody(path, request_head, request_tail))
+            batch.raise_for_status()
+            batch_id = batch.json()["id"]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            # One rejected job doesn't sink the ones already submitted
+            print(f"Anthropic batch submission failed for {len(custom_ids)} requests: {e}")
+            results.update({custom_id: {"error": str(e)} for custom_id in custom_ids})
+            continue
+        finally:
+            os.remove(path)
+        jobs[batch_id] = custom_ids
+        print(f"Anthropic batch {batch_id}: {len(custom_ids)} requests submitted")
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+    def poll(batch_id):
+        response = http_get(f"{base}/v1/messages/batches/{batch_id}", headers)
+        response.raise_for_status()
+        status = response.json()
+        print(f"Anthropic batch {batch_id}: {status.get('processing_status')} {status.get('request_counts', {})}")
+        return status
 
-    # Build content with images
-    content = [{"type": "text", "text": prompt}]
-    for img in images:
-        b64_data = encode_image(img)
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{b64_data}"
-            }
-        })
+    statuses = _wait_for_batches(jobs, poll, lambda s: s.get("processing_status") == "ended", poll_interval, timeout)
+    for batch_id, custom_ids in jobs.items():
+        status = statuses[batch_id]
+        if status.get("results_url"):
+            content = http_get(status["results_url"], headers)
+            content.raise_for_status()
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                result = record.get("result") or {}
+                if result.get("type") == "succeeded":
+                    results[record["custom_id"]] = result["message"]
+                else:
+                    results[record["custom_id"]] = {"error": f"{result.get('type')}: {result.get('error')}", "details": line}
+        for custom_id in custom_ids:
+            results.setdefault(custom_id, {"error": f"batch {batch_id} {status.get('processing_status')} without a result for this request"})
+    return results
 
-    payload = {
-        "model": model,
-        "messages": [{"role": "user", "content": content}],
-        "max_tokens": 8192
-    }
+def run_vision_batch(provider, api_key, base_url, model, items, image_budget=None, encoding_profile=None, poll_interval=None, timeout=None):
+    """
+    Recognize many documents with provider batch jobs instead of one
+    synchronous call each (batch pricing, no per-call latency).
+    items is a list of {'custom_id', 'images', 'prompt'}. Requests are
+    encoded one document at a time and written to temporary input files;
+    as many jobs are submitted as the provider's per-job limits require.
+    Blocks until every job finishes, polling every poll_interval seconds.
+    Returns {custom_id: response} where each response can go to
+    parse_vision_response, or is an error dict.
+    """
+    adapter = get_provider_adapter(provider)
+    if not adapter["run_batch"]:
+        return {item["custom_id"]: {"error": f"{adapter['label']} has no supported batch API"} for item in items}
+    if image_budget is None:
+        image_budget = adapter["image_budget"]
+    if poll_interval is None:
+        poll_interval = BATCH_POLL_INTERVAL
+    if timeout is None:
+        timeout = BATCH_TIMEOUT
 
+    # Headers don't depend on the request content
+    _, headers, _ = adapter["build_request"](
+        api_key, base_url, model, "", 0, image_mime_type(encoding_profile), structured_output=_structured_output(adapter)
+    )
+    bodies = _iter_batch_bodies(adapter, api_key, base_url, model, items, image_budget, encoding_profile)
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=90)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        error_details = "No response"
-        if 'response' in locals() and hasattr(response, 'text'):
-            try:
-                error_details = response.text
-            except:
-                error_details = "Unable to read response"
-        return {"error": str(e), "details": error_details}
+        with tempfile.TemporaryDirectory(prefix="vision_batch_") as out_dir:
+            return adapter["run_batch"](api_key, base_url, headers, bodies, out_dir, poll_interval, timeout)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print(f"{adapter['label']} batch failed: {e}")
+        return {item["custom_id"]: {"error": str(e)} for item in items}
+
+def chapter_page_ranges(chapters, offset, total_pages):
+    """
+    PDF page ranges for split_pdf_with_ranges: each chapter runs from its
+    start page (book page + offset) to the page before the next chapter,
+    the last one to the end of the PDF. Chapters with unusable page numbers
+    are skipped.
+    """
+    usable = []
+    for chapter in chapters:
+        try:
+            book_page = int(chapter.get('page'))
+        except (TypeError, ValueError):
+            continue
+        if book_page > 0:
+            usable.append((book_page + offset, chapter))
+    usable.sort(key=lambda item: item[0])
+
+    ranges = []
+    for i, (start_pdf, chapter) in enumerate(usable):
+        end_pdf = usable[i + 1][0] - 1 if i + 1 < len(usable) else total_pages
+        if 1 <= start_pdf <= min(end_pdf, total_pages):
+            ranges.append(dict(chapter, _start_pdf=start_pdf, _end_pdf=min(end_pdf, total_pages)))
+    return ranges
+
+def _loads_chapter(json_str):
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError:
+        # Trailing commas before a closing bracket are a common model slip
+        return json.loads(re.sub(r',\s*([}\]])', r'\1', json_str))
+
+class IncrementalJSONArrayParser:
+    """
+    Pull the objects of a JSON array out of text that arrives in chunks.
+    Each object is returned as soon as its closing brace has been fed, so a
+    streamed model response can be shown before the array is complete.
+    Text before the array (prose, markdown fences) is skipped.
+    """
+
+    def __init__(self):
+        self.items = []
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._object_start = None
+        self._closed = False
+
+    def feed(self, chunk):
+        """
+        Add text; returns the list of objects completed by it.
+        """
+        self._text += chunk
+        completed = []
+        text = self._text
+        i = self._pos
+        while i < len(text) and not self._closed:
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif self._depth == 0:
+                if ch == '[':
+                    self._depth = 1
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '[{':
+                if ch == '{' and self._depth == 1:
+                    self._object_start = i
+                self._depth += 1
+            elif ch in ']}':
+                self._depth -= 1
+                if ch == '}' and self._depth == 1 and self._object_start is not None:
+                    try:
+                        item = _loads_chapter(text[self._object_start:i + 1])
+                    except json.JSONDecodeError as e:
+                        print(f"Skipping malformed chapter object: {e}")
+                    else:
+                        completed.append(item)
+                    self._object_start = None
+                elif self._depth == 0:
+                    # A bracketed aside before the real array holds no objects; keep looking
+                    self._closed = bool(self.items or completed)
+            i += 1
+        self._pos = i
+        self.items.extend(completed)
+        return completed
+
+def parse_json_array(text, label="model"):
+    """
+    Objects of the JSON array in a model's text output.
+    Schema-constrained output ({"chapters": [...]}) is read directly. A
+    well-formed array is parsed as a whole (with the trailing-comma repair);
+    otherwise, e.g. when the output was cut off at the token limit, every
+    complete object before the damage is recovered.
+    """
+    if text.lstrip().startswith('{'):
+        try:
+            chapters = json.loads(text).get('chapters')
+            if isinstance(chapters, list):
+                return chapters
+        except (json.JSONDecodeError, AttributeError):
+            pass
+    start = text.find('[')
+    end = text.rfind(']') + 1
+    if start == -1:
+        return []
+    if end > start:
+        try:
+            result = _loads_chapter(text[start:end])
+            # A bracketed aside before the array (e.g. a footnote mark) is not the answer
+            if isinstance(result, list) and all(isinstance(item, dict) for item in result):
+                return result
+        except json.JSONDecodeError as json_err:
+            print(f"Error parsing {label} JSON: {json_err}")
+            print(f"JSON string (first 500 chars): {text[start:end][:500]}")
+    parser = IncrementalJSONArrayParser()
+    parser.feed(text)
+    if parser.items:
+        print(f"Recovered {len(parser.items)} complete objects from incomplete {label} JSON")
+    return parser.items
+
+def get_vision_usage(provider, response_json):
+    """
+    Token usage of a provider response: input_tokens (including prompt-cache
+    reads), cached_input_tokens and output_tokens; None where not reported.
+    """
+    return get_provider_adapter(provider)["usage"](response_json)
+
+def parse_vision_response(provider, response_json):
+    """
+    Parse a provider response with that provider's adapter.
+    """
+    return get_provider_adapter(provider)["parse_response"](response_json)
 
 def parse_gemini_response(response_json):
     """
@@ -295,26 +1999,7 @@ def parse_gemini_response(response_json):
             return []
 
         text = parts[0].get('text', '')
-
-        # Find JSON array
-        start = text.find('[')
-        end = text.rfind(']') + 1
-
-        if start != -1 and end != -1:
-            json_str = text[start:end]
-            try:
-                return json.loads(json_str)
-            except json.JSONDecodeError as json_err:
-                # Try to fix common JSON issues
-                # Remove trailing commas before closing brackets/braces
-                json_str_fixed = re.sub(r',\s*([}\]])', r'\1', json_str)
-                try:
-                    return json.loads(json_str_fixed)
-                except json.JSONDecodeError:
-                    print(f"Error parsing Gemini JSON: {json_err}")
-                    print(f"JSON string (first 500 chars): {json_str[:500]}")
-                    return []
-        return []
+        return parse_json_array(text, "Gemini")
     except Exception as e:
         print(f"Error parsing Gemini response: {e}")
         traceback.print_exc()
@@ -336,25 +2021,7 @@ def parse_openai_response(response_json):
         elif '```' in text:
             text = text.split('```')[1].split('```')[0].strip()
 
-        # Find JSON array
-        start = text.find('[')
-        end = text.rfind(']') + 1
-
-        if start != -1 and end != -1:
-            json_str = text[start:end]
-            try:
-                return json.loads(json_str)
-            except json.JSONDecodeError as json_err:
-                # Try to fix common JSON issues
-                import re
-                json_str_fixed = re.sub(r',\s*([}\]])', r'\1', json_str)
-                try:
-                    return json.loads(json_str_fixed)
-                except json.JSONDecodeError:
-                    print(f"Error parsing OpenAI JSON: {json_err}")
-                    print(f"JSON string (first 500 chars): {json_str[:500]}")
-                    return []
-        return []
+        return parse_json_array(text, "OpenAI")
     except Exception as e:
         print(f"Error parsing OpenAI response: {e}")
         traceback.print_exc()
@@ -370,6 +2037,12 @@ def parse_anthropic_response(response_json):
 
         content = response_json['content']
         if isinstance(content, list):
+            for block in content:
+                # Structured output arrives as the input of the forced tool call
+                if block.get('type') == 'tool_use':
+                    chapters = (block.get('input') or {}).get('chapters')
+                    if isinstance(chapters, list):
+                        return chapters
             text = ""
             for block in content:
                 if block.get('type') == 'text':
@@ -383,24 +2056,7 @@ def parse_anthropic_response(response_json):
         elif '```' in text:
             text = text.split('```')[1].split('```')[0].strip()
 
-        start = text.find('[')
-        end = text.rfind(']') + 1
-
-        if start != -1 and end != -1:
-            json_str = text[start:end]
-            try:
-                return json.loads(json_str)
-            except json.JSONDecodeError as json_err:
-                # Try to fix common JSON issues
-                import re
-                json_str_fixed = re.sub(r',\s*([}\]])', r'\1', json_str)
-                try:
-                    return json.loads(json_str_fixed)
-                except json.JSONDecodeError:
-                    print(f"Error parsing Claude JSON: {json_err}")
-                    print(f"JSON string (first 500 chars): {json_str[:500]}")
-                    return []
-        return []
+        return parse_json_array(text, "Claude")
     except Exception as e:
         print(f"Error parsing Claude response: {e}")
         traceback.print_exc()
@@ -412,6 +2068,482 @@ def parse_zhipu_response(response_json):
 def parse_qwen_response(response_json):
     return parse_openai_response(response_json)
 
+def build_page_group_prompt(prompt, group_index, group_count):
+    """
+    Prompt for one page group of a TOC split across concurrent requests.
+    """
+    if group_count <= 1:
+        return prompt
+    static, dynamic = prompt_parts(prompt)
+    note = (
+        f"# 分页识别说明\n"
+        f"目录共分 {group_count} 组图片分别识别，本次是第 {group_index + 1} 组。"
+        "只输出本次图片中出现的条目；跨页的条目按本页可见部分输出，不要补全其他页的内容。"
+    )
+    return (static, f"{dynamic}\n\n{note}" if dynamic else note)
+
+def merge_chapter_lists(partials):
+    """
+    Merge per-page chapter lists in page order, dropping entries repeated
+    across page seams (same title and page).
+    """
+    merged = []
+    seen = set()
+    for chapters in partials:
+        for chapter in chapters or []:
+            if not isinstance(chapter, dict):
+                continue
+            key = _chapter_key(chapter)
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(chapter)
+    return merged
+
+def recognize_toc_by_page(provider, api_key, base_url, model, images, prompt, pages_per_request=1, image_budget=None, encoding_profile=None, use_cache=True):
+    """
+    Recognize a TOC with one concurrent request per page group, then merge
+    the partial chapter lists back in page order.
+    Latency tracks the slowest group instead of the page count, and each
+    response stays far below max_tokens. The provider's concurrency slots
+    still bound how many groups are in flight.
+    Returns {'chapters': [...], 'errors': [...], 'cached_groups': n, 'groups': n}.
+    """
+    images = list(images)
+    pages_per_request = max(1, int(pages_per_request))
+    groups = [images[i:i + pages_per_request] for i in range(0, len(images), pages_per_request)]
+    if not groups:
+        return {"chapters": [], "errors": [], "cached_groups": 0, "groups": 0}
+
+    def recognize_group(index, group):
+        group_prompt = build_page_group_prompt(prompt, index, len(groups))
+        response = call_vision_api(
+            provider, api_key, base_url, model, group, group_prompt,
+            image_budget=image_budget, encoding_profile=encoding_profile, use_cache=use_cache
+        )
+        if "error" in response:
+            return [], f"第 {index + 1} 组: {response['error']}", False
+        return parse_vision_response(provider, response), None, "from_cache" in response
+
+    with ThreadPoolExecutor(max_workers=len(groups), thread_name_prefix="toc-page") as pool:
+        futures = [pool.submit(recognize_group, i, group) for i, group in enumerate(groups)]
+        results = [future.result() for future in futures]
+
+    return {
+        "chapters": merge_chapter_lists([chapters for chapters, _, _ in results]),
+        "errors": [error for _, error, _ in results if error],
+        "cached_groups": sum(1 for _, _, cached in results if cached),
+        "groups": len(groups),
+    }
+
+def recognize_toc_with_failover(chain, images, prompt, hedge_after=None, encoding_profile=None, use_cache=True):
+    """
+    Recognize with an ordered provider chain, e.g. Qwen -> Gemini -> OpenAI.
+    chain is a list of {'provider', 'api_key', 'base_url', 'model'} dicts.
+    The first provider is asked first; if it fails or returns nothing
+    parseable the next one is asked right away, and if it is still running
+    after hedge_after seconds the next one is asked in parallel (a hedged
+    request). The first parseable result wins; slower requests are left to
+    finish in the background and only fill the response cache.
+    Returns {'chapters', 'response', 'provider', 'attempts'} plus 'error'
+    when no provider produced a result.
+    """
+    if hedge_after is None:
+        hedge_after = HEDGE_AFTER_SECONDS
+    images = list(images)
+    attempts = []
+    pending = {}
+    pool = ThreadPoolExecutor(max_workers=max(1, len(chain)), thread_name_prefix="toc-hedge")
+
+    def recognize(entry):
+        response = call_vision_api(
+            entry["provider"], entry["api_key"], entry["base_url"], entry["model"], images, prompt,
+            encoding_profile=encoding_profile, use_cache=use_cache
+        )
+        if "error" in response:
+            return response, []
+        return response, parse_vision_response(entry["provider"], response)
+
+    def launch(index, reason):
+        entry = chain[index]
+        print(f"Recognition request to {entry['provider']} ({entry['model']}): {reason}")
+        pending[pool.submit(recognize, entry)] = (entry, time.perf_counter())
+
+    try:
+        if chain:
+            launch(0, "primary")
+        next_index = 1
+        while pending:
+            can_hedge = next_index < len(chain)
+            done, _ = wait(list(pending), timeout=hedge_after if can_hedge else None, return_when=FIRST_COMPLETED)
+            if not done:
+                launch(next_index, f"hedge after {hedge_after:.0f}s without a result")
+                next_index += 1
+                continue
+
+            for future in done:
+                entry, started = pending.pop(future)
+                try:
+                    response, chapters = future.result()
+                except Exception as e:
+                    response, chapters = {"error": str(e)}, []
+                attempt = {"provider": entry["provider"], "model": entry["model"], "seconds": time.perf_counter() - started}
+                if chapters:
+                    attempt["status"] = "ok"
+                    attempts.append(attempt)
+                    for _, (other, other_started) in pending.items():
+                        attempts.append({"provider": other["provider"], "model": other["model"],
+                                         "seconds": time.perf_counter() - other_started, "status": "superseded"})
+                    return {"chapters": chapters, "response": response, "provider": entry["provider"], "attempts": attempts}
+                attempt["status"] = response.get("error") or "no parseable chapters"
+                attempts.append(attempt)
+
+            if next_index < len(chain):
+                launch(next_index, "previous provider failed")
+                next_index += 1
+    finally:
+        pool.shutdown(wait=False)
+
+    errors = "; ".join(f"{a['provider']}: {a['status']}" for a in attempts)
+    return {"chapters": [], "response": None, "provider": None, "attempts": attempts,
+            "error": errors or "no providers configured"}
+
+# Provider adapters: request builder, response parser, whether the provider
+# accepts the chapter schema for constrained output (the OpenAI-compatible
+# Zhipu, Qwen and DeepSeek endpoints don't reliably accept json_schema), image
+# budget (the largest image the provider keeps before downsampling, see
+# budget_scale) and the maximum number of concurrent requests this process
+# sends to the provider.
+PROVIDER_ADAPTERS = {
+    "OpenAI": {
+        "label": "OpenAI",
+        "build_request": build_openai_request,
+        "parse_response": parse_openai_response,
+        "stream_request": openai_stream_request_with_usage,
+        "stream_delta": openai_stream_delta,
+        "text_response": openai_text_response,
+        "usage": openai_usage,
+        "truncated": openai_truncated,
+        "run_batch": run_openai_batch,
+        "structured_output": True,
+        "image_budget": {"long_side": 2048, "short_side": 768},  # high detail: 2048 box, then 768 short side
+        "max_concurrency": 8,
+    },
+    "Google Gemini": {
+        "label": "Gemini",
+        "build_request": build_gemini_request,
+        "parse_response": parse_gemini_response,
+        "stream_request": gemini_stream_request,
+        "stream_delta": gemini_stream_delta,
+        "text_response": gemini_text_response,
+        "usage": gemini_usage,
+        "truncated": gemini_truncated,
+        "run_batch": None,
+        "structured_output": True,
+        "image_budget": {"long_side": 3072},
+        "max_concurrency": 8,
+    },
+    "Anthropic Claude": {
+        "label": "Claude",
+        "build_request": build_claude_request,
+        "parse_response": parse_anthropic_response,
+        "stream_request": claude_stream_request,
+        "stream_delta": claude_stream_delta,
+        "text_response": claude_text_response,
+        "usage": claude_usage,
+        "truncated": claude_truncated,
+        "run_batch": run_anthropic_batch,
+        "structured_output": True,
+        "image_budget": {"long_side": 1568, "max_pixels": 1_150_000},  # ~1600 tokens
+        "max_concurrency": 4,
+    },
+    "智谱 AI (Zhipu AI)": {
+        "label": "Zhipu",
+        "build_request": build_openai_request,
+        "parse_response": parse_zhipu_response,
+        "stream_request": openai_stream_request,
+        "stream_delta": openai_stream_delta,
+        "text_response": openai_text_response,
+        "usage": openai_usage,
+        "truncated": openai_truncated,
+        "run_batch": None,
+        "structured_output": False,
+        "image_budget": {"long_side": 2048},
+        "max_concurrency": 2,
+    },
+    "阿里通义千问 (Qwen)": {
+        "label": "Qwen",
+        "build_request": build_openai_request,
+        "parse_response": parse_qwen_response,
+        "stream_request": openai_stream_request_with_usage,
+        "stream_delta": openai_stream_delta,
+        "text_response": openai_text_response,
+        "usage": openai_usage,
+        "truncated": openai_truncated,
+        "run_batch": run_openai_batch,
+        "structured_output": False,
+        "image_budget": {"long_side": 2048, "max_pixels": 1280 * 28 * 28},  # default 1280 visual tokens
+        "max_concurrency": 4,
+    },
+    "DeepSeek": {
+        "label": "DeepSeek",
+        "build_request": build_openai_request,
+        "parse_response": parse_openai_response,
+        "stream_request": openai_stream_request_with_usage,
+        "stream_delta": openai_stream_delta,
+        "text_response": openai_text_response,
+        "usage": openai_usage,
+        "truncated": openai_truncated,
+        "run_batch": None,
+        "structured_output": False,
+        "image_budget": {"long_side": 2048},
+        "max_concurrency": 4,
+    },
+}
+
+for _name, _adapter in PROVIDER_ADAPTERS.items():
+    _adapter["name"] = _name
+
+# Optional per-provider concurrency overrides, e.g. '{"OpenAI": 16, "DeepSeek": 2}'
+for _name, _limit in json.loads(os.environ.get("PDF_SPLITTER_PROVIDER_CONCURRENCY", "{}")).items():
+    if _name in PROVIDER_ADAPTERS:
+        PROVIDER_ADAPTERS[_name]["max_concurrency"] = int(_limit)
+
+_provider_semaphores = {}
+_provider_semaphores_lock = threading.Lock()
+
+def extract_text_layer(pdf_path, first_page, last_page):
+    """
+    Extract the text layer of pages first_page..last_page (1-based, inclusive).
+    Returns one string per page; pages without text yield ''.
+    """
+    try:
+        reader = PdfReader(pdf_path, strict=False)
+    except Exception as e:
+        print(f"Error reading PDF: {e}")
+        return []
+
+    texts = []
+    for page_num in range(first_page - 1, min(last_page, len(reader.pages))):
+        try:
+            texts.append(reader.pages[page_num].extract_text() or '')
+        except Exception as e:
+            print(f"Error extracting text from page {page_num + 1}: {e}")
+            texts.append('')
+    return texts
+
+def _is_readable_char(ch):
+    """
+    Characters expected in a real TOC: CJK, letters, digits, punctuation, spaces.
+    Private-use glyphs, replacement and control characters indicate broken font maps.
+    """
+    if ch.isspace() or ch.isalnum():
+        return True
+    code = ord(ch)
+    if 0xE000 <= code <= 0xF8FF or ch == '\ufffd':
+        return False
+    return ch.isprintable()
+
+def is_usable_text_layer(page_texts, min_chars_per_page=30, min_readable_ratio=0.9):
+    """
+    Decide whether extracted TOC text is good enough to replace the page images.
+    Every page needs some text, the text must be mostly readable (not garbled
+    by a broken ToUnicode map) and it must contain page numbers.
+    """
+    if not page_texts:
+        return False
+    for text in page_texts:
+        if len("".join(text.split())) < min_chars_per_page:
+            return False
+
+    all_text = "".join(page_texts)
+    if '(cid:' in all_text:
+        return False
+    readable = sum(1 for ch in all_text if _is_readable_char(ch))
+    if readable / len(all_text) < min_readable_ratio:
+        return False
+    return sum(1 for ch in all_text if ch.isdigit()) >= 3
+
+def build_text_toc_prompt(prompt, page_texts):
+    """
+    Append the TOC text layer to the recognition prompt for a text-only request.
+    Returns (prompt, document text) so the prompt stays a cacheable prefix.
+    """
+    sections = [
+        "# 目录文本（替代图片）",
+        "本次没有上传目录图片，下面是从 PDF 文本层直接提取的目录页文字（按页分隔）。"
+        "排版缩进可能丢失，请根据编号和标题判断层级，其余规则与上文完全相同。",
+    ]
+    for i, text in enumerate(page_texts, 1):
+        sections.append(f"\n--- 第 {i} 页 ---\n{text.strip()}")
+    return (prompt, "\n".join(sections))
+
+# Printed page numbers in running headers/footers: "12", "- 12 -", "第 12 页",
+# or a number at either end of a header line ("12 第一章 声现象")
+_PRINTED_PAGE_PATTERNS = [
+    re.compile(r'^[-—–·\s]*(\d{1,4})[-—–·\s]*$'),
+    re.compile(r'^第\s*(\d{1,4})\s*页$'),
+    re.compile(r'^(\d{1,4})\s+\D'),
+    re.compile(r'\D\s+(\d{1,4})$'),
+]
+
+def _offset_from_page_labels(reader):
+    """
+    Majority offset (PDF page - book page) over pages with decimal /PageLabels.
+    Returns None when the document has no /PageLabels number tree.
+    """
+    try:
+        if "/PageLabels" not in reader.trailer["/Root"]:
+            return None
+        labels = reader.page_labels
+    except Exception as e:
+        print(f"Error reading page labels: {e}")
+        return None
+
+    votes = {}
+    for index, label in enumerate(labels):
+        if label.isdigit():
+            offset = index + 1 - int(label)
+            votes[offset] = votes.get(offset, 0) + 1
+    if not votes:
+        return None
+    offset, count = max(votes.items(), key=lambda kv: kv[1])
+    return {"offset": offset, "confidence": count / sum(votes.values()), "source": "page_labels", "samples": sum(votes.values())}
+
+def _printed_page_candidates(text):
+    """
+    Page numbers printed in the first/last two lines of a page's text.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    candidates = set()
+    for line in lines[:2] + lines[-2:]:
+        for pattern in _PRINTED_PAGE_PATTERNS:
+            match = pattern.search(line)
+            if match:
+                candidates.add(int(match.group(1)))
+    return candidates
+
+def _offset_from_printed_numbers(reader, max_samples=24):
+    """
+    Majority offset from page numbers printed on sampled body pages.
+    Pages are sampled evenly from the middle 80% of the book to skip
+    front matter and appendices.
+    """
+    total_pages = len(reader.pages)
+    if total_pages == 0:
+        return None
+    first = int(total_pages * 0.1)
+    last = max(first + 1, int(total_pages * 0.9))
+    step = max(1, (last - first) // max_samples)
+    sample_indices = list(range(first, last, step))[:max_samples]
+
+    votes = {}
+    pages_with_numbers = 0
+    for index in sample_indices:
+        try:
+            text = reader.pages[index].extract_text() or ''
+        except Exception:
+            continue
+        offsets = {index + 1 - n for n in _printed_page_candidates(text) if 0 < n <= total_pages}
+        if not offsets:
+            continue
+        pages_with_numbers += 1
+        for offset in offsets:
+            votes[offset] = votes.get(offset, 0) + 1
+
+    if not votes:
+        return None
+    offset, count = max(votes.items(), key=lambda kv: kv[1])
+    # Confidence: share of sampled pages whose printed number agrees,
+    # scaled down when only a handful of pages could be read
+    confidence = count / len(sample_indices) * min(1.0, pages_with_numbers / 5)
+    return {"offset": offset, "confidence": confidence, "source": "printed_numbers", "samples": pages_with_numbers}
+
+def detect_page_offset(pdf_path):
+    """
+    Detect the page offset (PDF page = book page + offset) without user input.
+    Uses the /PageLabels number tree when present, otherwise the majority
+    vote of printed page numbers in the text layer of sampled body pages.
+    Returns a dict with 'offset', 'confidence' (0-1), 'source' and 'samples',
+    or None when the PDF carries neither.
+    """
+    try:
+        reader = PdfReader(pdf_path, strict=False)
+    except Exception as e:
+        print(f"Error reading PDF: {e}")
+        return None
+
+    result = _offset_from_page_labels(reader)
+    if result is None:
+        result = _offset_from_printed_numbers(reader)
+    return result
+
+def _flatten_outline(reader, outline, level, max_level, entries):
+    """
+    Walk pypdf's nested outline list depth-first.
+    A nested list holds the children of the item right before it.
+    """
+    for i, item in enumerate(outline):
+        if isinstance(item, list):
+            if level < max_level:
+                _flatten_outline(reader, item, level + 1, max_level, entries)
+            continue
+        try:
+            page_index = reader.get_destination_page_number(item)
+        except Exception as e:
+            print(f"Skipping outline item {item.get('/Title')}: {e}")
+            continue
+        if page_index is None or page_index < 0:
+            continue
+        # Children deeper than max_level are never emitted, so they don't make this a unit heading
+        has_children = (level < max_level and i + 1 < len(outline)
+                        and isinstance(outline[i + 1], list) and len(outline[i + 1]) > 0)
+        entries.append({
+            'title': str(item.get('/Title', '')).strip(),
+            'pdf_page': page_index + 1,
+            'level': level,
+            'has_children': has_children
+        })
+
+def extract_outline_toc(pdf_path, offset=0, max_level=2):
+    """
+    Build chapter data from the PDF's embedded outline (bookmarks), no API call.
+    Returns the same dicts as the vision parsers ('title', 'page', 'filename', 'type'),
+    with 'page' converted back to a book page via offset (PDF page = book page + offset).
+    Entries that land on the same page as an earlier one are merged into it,
+    and entries before book page 1 (cover, front matter) are skipped.
+    """
+    try:
+        reader = PdfReader(pdf_path, strict=False)
+        outline = reader.outline
+    except Exception as e:
+        print(f"Error reading PDF outline: {e}")
+        return []
+
+    entries = []
+    _flatten_outline(reader, outline, 1, max_level, entries)
+
+    chapters = []
+    seen_pages = set()
+    for entry in sorted(entries, key=lambda x: x['pdf_page']):
+        book_page = entry['pdf_page'] - offset
+        if book_page < 1:
+            print(f"Skipping outline item '{entry['title']}': before book page 1 (PDF page {entry['pdf_page']})")
+            continue
+        if entry['pdf_page'] in seen_pages or not entry['title']:
+            continue
+        seen_pages.add(entry['pdf_page'])
+
+        chapter_type = "导读" if entry['has_children'] else "课题"
+        safe_title = "".join([c for c in entry['title'] if c.isalnum() or c in (' ', '_', '-', '.')]).strip()
+        chapters.append({
+            'title': entry['title'],
+            'page': book_page,
+            'type': chapter_type,
+            'filename': f"{len(chapters) + 1:02d}_{chapter_type}_{safe_title}"
+        })
+    return chapters
+
 def split_pdf(original_pdf_path, chapter_data, offset, output_dir):
     """
     Split PDF based on chapter data and offset.